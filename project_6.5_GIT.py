@@ -1,10 +1,8 @@
 import sqlite3
 import requests
 import logging
-from itertools import permutations
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler
 import time
-import datetime as dt
-from datetime import datetime
 import json
 import websockets
 import threading
@@ -17,37 +15,191 @@ import traceback
 import os
 import math
 import sys
+from array import array
+import random
+from collections import deque, namedtuple
+from bisect import bisect_left
+import zlib
+import uuid
+import struct
+import mmap
+import atexit
+import hashlib
+import gzip
+import shutil
+import queue
+import signal
+from concurrent.futures import ThreadPoolExecutor
+import heapq
+import multiprocessing
+from multiprocessing import shared_memory
+
+try:
+    import numpy as np
+except ImportError:  # Без NumPy анализ идёт построчным циклом
+    np = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:  # Без msgspec/orjson кадры разбирает стандартный json
+    msgspec = None
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 
 
-# Настройка логирования
-logging.basicConfig(
-    filename="debug_log.txt",
-    filemode="w",
-    level=logging.ERROR,  # Оставляем DEBUG, но фильтруем лишнее
-    format="%(asctime)s - %(levelname)s - %(message)s"
-)
-
-
 # Константы
 OKX_API_TRADE = "https://www.okx.com"
-OKX_PRIVAT_URL = "wss://ws.okx.com:8443/ws/v5/private"
-OKX_WS_URL = "wss://ws.okx.com:8443/ws/v5/public"
-OKX_API_URL = "https://www.okx.com/api/v5"
+# Адреса можно переопределить переменными окружения (например, на локальную биржу `mock-exchange`)
+OKX_PRIVAT_URL = os.environ.get("OKX_PRIVAT_URL", "wss://ws.okx.com:8443/ws/v5/private")
+OKX_WS_URL = os.environ.get("OKX_WS_URL", "wss://ws.okx.com:8443/ws/v5/public")
+OKX_API_URL = os.environ.get("OKX_API_URL", "https://www.okx.com/api/v5")
 INITIAL_BALANCE = 1000  # Стартовый баланс для проверки
 UPDATE_INTERVAL = 1  # Интервал обновления (в секундах)
 TARGET_CURRENCIES = {"USDT", "USDC"}  # Только финальные конвертации
 TARGET_CURRENCIES2 = {"BTC", "ETH", "SOL", "OKB", "BCH", "BSV", "LTC"}
 TARGET_CURRENCIES_DEF = {"USDT", "USDC", "BTC", "ETH"}
 EXCLUDED_CURRENCIES = {"USD", "UAH", "EUR", "JPY", "CNY", "GBP", "CHF", "AUD", "CAD", "BRL", "SGD", "HKD", "KRW", "RUB", "INR", "MXN", "TRY", "AED"}  # Исключаем фиатные валюты
-PROFIT_PERCENT = 1010
-ORDER_SIZE = 5
-MIN_TRADE_SIZE = 0.0001  # Минимальный размер ордера
-TICK_SIZE = 0.0001  # Минимальный шаг округления
-
-# 🔹 Округляем размер ордера по `TICK_SIZE`
-def round_to_tick_size(amount):
-    return math.floor(amount / TICK_SIZE) * TICK_SIZE
+MAX_CYCLE_LENGTH = 3  # Максимальная длина маршрута (3 — только треугольники, до 5 — длинные циклы в таблицу cycles)
+PROFIT_PERCENT = 1010  # Порог final_balance из INITIAL_BALANCE по лучшим ценам без комиссий (запас на TRADE_FEE × 3 — внутри)
+TRADE_FEE = 0.0011  # Комиссия за сделку (0.11%)
+STRATEGY_MODE = "triangles"  # "triangles" — фиксированные треугольники, "negative_cycles" — поиск отрицательных циклов (SPFA)
+ORDER_SIZE = 5  # Минимальный объём первой сделки (в валюте котировки), меньше — не торгуем
+TRADE_HEARTBEAT_INTERVAL = 20  # Период "ping" в торговом WebSocket (OKX закрывает соединение после 30 сек тишины)
+ORDER_REPLY_TIMEOUT = 5  # Сколько ждать ответа биржи на ордер (в секундах)
+PERSIST_FLUSH_MS = 50  # Как часто писатель SQLite фиксирует накопленное (в миллисекундах)
+PERSIST_BATCH_ROWS = 1000  # Или раньше, если набралось столько строк
+PERSIST_QUEUE_SIZE = 100_000  # Предел очереди записи; при переполнении записи отбрасываются, а не блокируют
+ORDER_FILL_TIMEOUT = 10  # Сколько ждать финального состояния ордера из канала `orders` (в секундах)
+EXECUTION_MODE = "sequential"  # "sequential" — ноги по очереди по факту исполнения, "parallel" — все три сразу из запаса
+INVENTORY_TARGETS = {}  # Запас для параллельного режима: валюта -> цель, например {"USDT": 1000, "USDC": 1000, "BTC": 0.02}
+INVENTORY_BAND = 0.2  # Допустимое отклонение запаса от цели (доля), за пределами — ребалансировка
+INVENTORY_BANDS = {}  # Своя полоса для отдельных валют, например {"BTC": 0.5}
+INVENTORY_ANCHOR = "USDT"  # Через какую валюту выравнивается запас остальных
+INVENTORY_REBALANCE_INTERVAL = 5  # Период проверки запаса (в секундах)
+BATCH_ORDERS = True  # Параллельный режим: три ноги одним кадром `batch-orders`
+EVALUATION_EXECUTOR = True  # Полный пересчёт треугольников в отдельном потоке, False — прямо в цикле событий
+RUNTIME_HEALTH_INTERVAL = 5  # Период проверок здоровья рантайма (в секундах)
+RUNTIME_LAG_BUDGET = 0.05  # Задержка цикла событий (в секундах), выше которой фоновые задачи пропускают запуск
+RUNTIME_STALE_FEED = 10  # Сколько секунд без котировок считать поток стаканов зависшим
+RUNTIME_SHUTDOWN_TIMEOUT = 5  # Сколько ждать завершения сделок и задач при остановке (в секундах)
+OPPORTUNITY_TTL = 0.5  # Предельный возраст возможности с момента оценки (в секундах), старше — не исполняем
+SIZING_DEPTH = 50  # Сколько уровней стакана учитывать при расчёте объёма сделки
+BOOK_CHECKSUM = True  # Проверять CRC32 стакана OKX на каждом сообщении
+RECORD_PATH = None  # Файл для записи сырого потока WebSocket (например, "feed.rec"), None — не записывать
+RECORD_COMPRESS = True  # Сжимать запись блоками zlib
+LATENCY_METRICS = True  # Замерять задержки этапов «тик → сделка»
+METRICS_DUMP_INTERVAL = 60  # Период записи гистограмм задержек в лог (в секундах)
+METRICS_PORT = 9108  # Порт локального эндпоинта метрик Prometheus (/metrics), 0 — не запускать
+INGEST_WORKERS = 0  # Процессов-шардов для приёма стаканов (0 — всё в одном процессе, как раньше)
+SHARED_BOOK_DEPTH = 20  # Сколько уровней каждой стороны стакана шарды публикуют в общую память
+SHARED_POLL_INTERVAL = 0.0005  # Пауза опроса общей памяти, когда обновлений нет (в секундах)
+SEQLOCK_RETRIES = 1000  # Попыток согласованного чтения строки, пока её пишет шард
+JSON_BACKEND = "auto"  # Разбор кадров WebSocket: "auto" (msgspec → orjson → json), "msgspec", "orjson", "json"
+LAZY_BOOK_DECODE = True  # msgspec: уровни стакана остаются сырым JSON, пока сообщение не применяют к стакану
+USE_UVLOOP = True  # Цикл событий на uvloop, если он установлен
+BOOK_CHANNEL = "books"  # Канал котировок по умолчанию: "books" (400 уровней, инкременты), "books5" (5 уровней), "bbo-tbt" (только лучшие цены)
+BOOK_CHANNELS = {}  # Канал для отдельных инструментов, например {"BTC-USDT": "books", "ALT-USDT": "bbo-tbt"}
+WS_ARGS_PER_CONNECTION = 100  # Сколько инструментов держать на одном публичном соединении
+WS_MSG_RATE_BUDGET = 300  # Допустимый поток сообщений на соединение (в сек), выше — разгружаем
+WS_MAX_CONNECTIONS = 20  # Предел публичных соединений с одного IP
+WS_CONNECT_INTERVAL = 0.35  # Пауза между открытиями соединений (OKX: не более 3 в секунду)
+WS_SUBSCRIBE_BATCH = 100  # Аргументов в одном запросе subscribe/unsubscribe
+WS_REBALANCE_INTERVAL = 30  # Период пересчёта нагрузки соединений (в секундах)
+WS_REBALANCE_MOVES = 5  # Сколько инструментов переносить за один пересчёт
+INSTRUMENT_CACHE_TTL = 3600  # Сколько секунд список инструментов из кэша считается свежим (0 — запрашивать всегда)
+QUOTE_SNAPSHOT_INTERVAL = 10  # Период сброса котировок в tab_2 (в секундах, 0 — не сохранять)
+OPPORTUNITY_LOG_PATH = "opportunities.jsonl"  # Журнал найденных возможностей (JSON lines), None — не писать
+TRADE_LOG_PATH = "trades.jsonl"  # Журнал исполнений и сделок (JSON lines), None — не писать
+EVENT_LOG_MAX_BYTES = 50 * 1024 * 1024  # Ротация журналов событий по размеру
+EVENT_LOG_ROTATE_WHEN = None  # Или по времени ("midnight", "H" — как в TimedRotatingFileHandler), None — по размеру
+EVENT_LOG_BACKUPS = 10  # Сколько старых файлов журнала хранить
+EVENT_LOG_COMPRESS = True  # Сжимать ушедшие в ротацию файлы gzip
+
+
+# Настройка логирования: вызывающий поток только кладёт запись в очередь,
+# форматирует и пишет на диск отдельный поток
+class LazyQueueHandler(QueueHandler):
+    """QueueHandler без форматирования в вызывающем потоке: подстановка `%s` выполняется в потоке записи."""
+
+    def prepare(self, record):
+        if record.exc_info:  # Трассировку снимаем сразу, пока исключение ещё доступно
+            return super().prepare(record)
+        return record
+
+class JsonLinesFormatter(logging.Formatter):
+    """Событие одной строкой JSON: время, тип (`msg`) и поля из словаря-аргумента записи."""
+
+    def format(self, record):
+        event = {"ts": round(record.created, 6), "event": record.msg}
+        if isinstance(record.args, dict):
+            event.update(record.args)
+        return json.dumps(event, ensure_ascii=False, separators=(",", ":"), default=str)
+
+def gzip_rotator(source, dest):
+    """Сжимает файл, ушедший в ротацию (`dest` уже с суффиксом .gz от `namer`)."""
+    with open(source, "rb") as src, gzip.open(dest, "wb") as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(source)
+
+def event_log_handler(name, path):
+    """Файл журнала событий логгера `name` с ротацией по размеру или по времени."""
+    if EVENT_LOG_ROTATE_WHEN:
+        handler = TimedRotatingFileHandler(path, when=EVENT_LOG_ROTATE_WHEN, backupCount=EVENT_LOG_BACKUPS,
+                                           encoding="utf-8", delay=True)
+    else:
+        handler = RotatingFileHandler(path, maxBytes=EVENT_LOG_MAX_BYTES, backupCount=EVENT_LOG_BACKUPS,
+                                      encoding="utf-8", delay=True)
+    if EVENT_LOG_COMPRESS:
+        handler.namer = lambda filename: filename + ".gz"
+        handler.rotator = gzip_rotator
+    handler.setFormatter(JsonLinesFormatter())
+    handler.addFilter(lambda record: record.name == name)
+    return handler
+
+def start_log_listener():
+    """Поток записи логов; свой в каждом процессе (шард, запущенный через spawn, поднимает его при импорте)."""
+    global log_listener
+    log_listener = QueueListener(log_queue, *log_handlers, respect_handler_level=True)
+    log_listener.start()
+
+log_queue = queue.SimpleQueue()
+opportunity_log = logging.getLogger("opportunities")  # opportunity_log.info("opportunity", {поля})
+trade_log = logging.getLogger("trades")
+event_logs = {opportunity_log.name: OPPORTUNITY_LOG_PATH, trade_log.name: TRADE_LOG_PATH}
+
+# Журнал обнуляет только главный процесс (шарды импортируют скрипт повторно), а пишут все в режиме дозаписи:
+# у "w" своё смещение, и строки главного процесса затирали бы строки шардов
+if multiprocessing.current_process().name == "MainProcess":
+    open("debug_log.txt", "w").close()
+debug_handler = logging.FileHandler("debug_log.txt", mode="a", encoding="utf-8")
+debug_handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+debug_handler.addFilter(lambda record: record.name not in event_logs)
+log_handlers = [debug_handler]
+for name, path in event_logs.items():
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.INFO)
+    logger.disabled = path is None
+    if path:
+        log_handlers.append(event_log_handler(name, path))
+
+logging.getLogger().setLevel(logging.ERROR)  # В debug_log.txt — только ошибки, как раньше
+logging.getLogger().addHandler(LazyQueueHandler(log_queue))
+log_listener = None
+start_log_listener()
+atexit.register(lambda: log_listener.stop())
+
+def ws_ssl_context(url):
+    """SSL-контекст для wss://, None для незашифрованного ws:// (локальная биржа)."""
+    return ssl.create_default_context(cafile=certifi.where()) if url.startswith("wss://") else None
 
 # Загружаем АПИ ключ из txt файла
 def load_api_keys():
@@ -63,149 +215,1161 @@ def generate_signature(timestamp, method, path, body, secret_key):
     signature = hmac.new(secret_key.encode(), message.encode(), digestmod="sha256").digest()
     return base64.b64encode(signature).decode()
 
-# Создаем соединение с SQLite
-conn = sqlite3.connect("arbitrage.db", check_same_thread=False)
-cursor = conn.cursor()
-
-# Оптимизация SQLite
-cursor.execute("PRAGMA journal_mode=WAL;")
-cursor.execute("PRAGMA synchronous=NORMAL;")
-
-# Пересоздание базы данных, если файла нет
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS tab_1 (
-    pair TEXT PRIMARY KEY,
-    bid_price REAL DEFAULT NULL,
-    ask_price REAL DEFAULT NULL
-);
-""")
-
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS tab_2 (
-    pair1 TEXT,
-    pair2 TEXT,
-    pair3 TEXT,
-    bid1 REAL DEFAULT NULL,
-    ask1 REAL DEFAULT NULL,
-    bid1_volume REAL DEFAULT NULL,
-    ask1_volume REAL DEFAULT NULL,
-    bid2 REAL DEFAULT NULL,
-    ask2 REAL DEFAULT NULL,
-    bid2_volume REAL DEFAULT NULL,
-    ask2_volume REAL DEFAULT NULL,
-    bid3 REAL DEFAULT NULL,
-    ask3 REAL DEFAULT NULL,
-    bid3_volume REAL DEFAULT NULL,
-    ask3_volume REAL DEFAULT NULL
-);
-""")
-
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS tab_3 (
-    pair1 TEXT,
-    bid1 REAL,
-    ask1 REAL,
-    pair2 TEXT,
-    bid2 REAL,
-    ask2 REAL,
-    pair3 TEXT,
-    bid3 REAL,
-    ask3 REAL,
-    final_balance REAL
-);
-""")
-
-# Таблица для баланса
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS balances (
-    currency TEXT PRIMARY KEY,
-    available REAL,
-    reserved REAL
-);
-""")
-
-# Таблица для ордеров
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS open_orders (
-    order_id TEXT PRIMARY KEY,
-    pair TEXT,
-    type TEXT,
-    price REAL,
-    quantity REAL,
-    created_at TIMESTAMP
-);
-""")
-cursor.execute("DELETE FROM open_orders")
-conn.commit()
-conn.close()
+def init_database():
+    """Схема БД и очистка `open_orders` прошлого запуска. Только из `__main__`: шарды (spawn) импортируют
+    скрипт заново, и модульный код стирал бы открытые ордера главного процесса при каждом перезапуске шарда."""
+    # Создаем соединение с SQLite
+    conn = sqlite3.connect("arbitrage.db", check_same_thread=False)
+    cursor = conn.cursor()
+
+    # Оптимизация SQLite
+    cursor.execute("PRAGMA journal_mode=WAL;")
+    cursor.execute("PRAGMA synchronous=NORMAL;")
+
+    # Пересоздание базы данных, если файла нет
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS tab_1 (
+        pair TEXT PRIMARY KEY,
+        bid_price REAL DEFAULT NULL,
+        ask_price REAL DEFAULT NULL
+    );
+    """)
+
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS tab_2 (
+        pair1 TEXT,
+        pair2 TEXT,
+        pair3 TEXT,
+        bid1 REAL DEFAULT NULL,
+        ask1 REAL DEFAULT NULL,
+        bid1_volume REAL DEFAULT NULL,
+        ask1_volume REAL DEFAULT NULL,
+        bid2 REAL DEFAULT NULL,
+        ask2 REAL DEFAULT NULL,
+        bid2_volume REAL DEFAULT NULL,
+        ask2_volume REAL DEFAULT NULL,
+        bid3 REAL DEFAULT NULL,
+        ask3 REAL DEFAULT NULL,
+        bid3_volume REAL DEFAULT NULL,
+        ask3_volume REAL DEFAULT NULL
+    );
+    """)
+
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS tab_3 (
+        pair1 TEXT,
+        bid1 REAL,
+        ask1 REAL,
+        pair2 TEXT,
+        bid2 REAL,
+        ask2 REAL,
+        pair3 TEXT,
+        bid3 REAL,
+        ask3 REAL,
+        final_balance REAL
+    );
+    """)
+
+    # Таблица для баланса
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS balances (
+        currency TEXT PRIMARY KEY,
+        available REAL,
+        reserved REAL
+    );
+    """)
+
+    # Таблица для ордеров
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS open_orders (
+        order_id TEXT PRIMARY KEY,
+        pair TEXT,
+        type TEXT,
+        price REAL,
+        quantity REAL,
+        created_at TIMESTAMP
+    );
+    """)
+    # Таблица для длинных маршрутов (4–5 валют)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS cycles (
+        length INTEGER,
+        route TEXT
+    );
+    """)
+    # Кэш параметров инструментов с `/public/instruments`
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS instruments (
+        inst_id TEXT PRIMARY KEY,
+        base TEXT,
+        quote TEXT,
+        tick_sz TEXT,
+        lot_sz TEXT,
+        min_sz TEXT,
+        state TEXT
+    );
+    """)
+    # Служебные значения кэша: время запроса инструментов, их отпечаток, отпечаток набора треугольников
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS cache_meta (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    );
+    """)
+    # Найденные возможности и исполнения ордеров (пишутся фоново)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS opportunities (
+        found_at REAL,
+        pair1 TEXT,
+        pair2 TEXT,
+        pair3 TEXT,
+        final_balance REAL
+    );
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS fills (
+        order_id TEXT PRIMARY KEY,
+        pair TEXT,
+        side TEXT,
+        state TEXT,
+        filled_size REAL,
+        avg_price REAL,
+        fee REAL,
+        fee_currency TEXT,
+        filled_at REAL
+    );
+    """)
+    cursor.execute("DELETE FROM open_orders")
+    conn.commit()
+    conn.close()
+
+# Запросы фоновой записи (одни и те же строки SQL — sqlite3 держит их подготовленными в кэше соединения)
+UPSERT_BALANCE = """
+    INSERT INTO balances (currency, available, reserved) VALUES (?, ?, ?)
+    ON CONFLICT(currency) DO UPDATE SET available = excluded.available, reserved = excluded.reserved
+"""
+UPSERT_OPEN_ORDER = """
+    INSERT INTO open_orders (order_id, pair, type, price, quantity, created_at) VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT(order_id) DO UPDATE SET price = excluded.price, quantity = excluded.quantity
+"""
+DELETE_OPEN_ORDER = "DELETE FROM open_orders WHERE order_id = ?"
+INSERT_FILL = "INSERT OR REPLACE INTO fills VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+INSERT_OPPORTUNITY = "INSERT INTO opportunities VALUES (?, ?, ?, ?, ?)"
+
+
+# Единственный писатель SQLite: горячие пути только кладут запись в очередь
+class PersistenceService:
+    """Очередь записей и один поток с одним соединением, который фиксирует их пачками
+    раз в `PERSIST_FLUSH_MS` или по `PERSIST_BATCH_ROWS` строк. Переполнение очереди не блокирует
+    вызывающего: запись отбрасывается и учитывается в `dropped`."""
+
+    def __init__(self, path="arbitrage.db", flush_ms=PERSIST_FLUSH_MS, batch_rows=PERSIST_BATCH_ROWS,
+                 max_queue=PERSIST_QUEUE_SIZE):
+        self.path = path
+        self.flush_interval = flush_ms / 1000
+        self.batch_rows = batch_rows
+        self.queue = queue.Queue(max_queue)
+        self.thread = None
+        # Метрики
+        self.written = 0
+        self.batches = 0
+        self.dropped = 0
+        self.errors = 0
+        self.max_depth = 0
+        self.last_batch_rows = 0
+        self.commit_seconds = 0.0
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name="sqlite-writer", daemon=True)
+            self.thread.start()
+
+    def write(self, sql, params=()):
+        """Одна строка: INSERT/UPDATE/DELETE с параметрами."""
+        self._put((sql, params, False))
+
+    def write_many(self, sql, rows):
+        """Пачка строк одним executemany."""
+        self._put((sql, rows, True))
+
+    def _put(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+            return
+        depth = self.queue.qsize()
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+    def flush(self, timeout=5):
+        """Ждёт, пока всё поставленное до вызова будет зафиксировано (для остановки и проверок)."""
+        if self.thread is None:
+            return False
+        done = threading.Event()
+        self._put((None, done, False))
+        return done.wait(timeout)
+
+    def run(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute("PRAGMA journal_mode=WAL;")
+        conn.execute("PRAGMA synchronous=NORMAL;")
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_rows:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self.commit(conn, batch)
+
+    def commit(self, conn, batch):
+        started = time.perf_counter()
+        waiters = [params for sql, params, many in batch if sql is None]
+        writes = [item for item in batch if item[0] is not None]
+        try:
+            rows = self.execute(conn, writes)
+            conn.commit()
+        except Exception as e:
+            # Пакет откатился целиком: повторяем по одной записи, чтобы потерять только сбойную
+            conn.rollback()
+            logging.error(f"⚠️ Ошибка пакетной записи в БД ({len(writes)} записей): {e}")
+            rows = 0
+            for item in writes:
+                try:
+                    rows += self.execute(conn, [item])
+                    conn.commit()
+                except Exception as e:
+                    self.errors += 1
+                    conn.rollback()
+                    logging.error(f"⚠️ Запись в БД отброшена: {e} ({item[0].split()[0]} …)")
+        self.written += rows
+        self.batches += 1
+        self.last_batch_rows = rows
+        self.commit_seconds += time.perf_counter() - started
+        for done in waiters:
+            done.set()
+
+    @staticmethod
+    def execute(conn, writes):
+        """Соседние одиночные записи с одинаковым SQL выполняет одним executemany."""
+        rows = 0
+        pending_sql, pending = None, []
+        for sql, params, many in writes + [(None, None, False)]:
+            if pending and (sql != pending_sql or many):
+                conn.executemany(pending_sql, pending)
+                rows += len(pending)
+                pending = []
+            if many:
+                conn.executemany(sql, params)
+                rows += len(params)
+            elif sql is not None:
+                pending_sql = sql
+                pending.append(params)
+        return rows
+
+    def stats(self):
+        return {
+            "queue_depth": self.queue.qsize(), "max_queue_depth": self.max_depth, "written_rows": self.written,
+            "batches": self.batches, "last_batch_rows": self.last_batch_rows, "dropped": self.dropped,
+            "errors": self.errors, "commit_seconds": self.commit_seconds,
+        }
+
+
+persistence = PersistenceService()
+atexit.register(persistence.flush, 2)
+
+# Гистограммы задержек по этапам: кадр получен → JSON разобран → стакан обновлён → треугольники
+# посчитаны → ордер отправлен → ордер подтверждён → исполнение получено
+class LatencyHistogram:
+    """HDR-подобная гистограмма в наносекундах: логарифмические корзины с 32 линейными делениями (~3%)."""
+
+    BITS = 6
+    HALF = 1 << (BITS - 1)
+
+    def __init__(self):
+        self.counts = array("q", [0] * ((64 - self.BITS + 2) * self.HALF))
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, value):
+        if value < 0:
+            value = 0
+        shift = value.bit_length() - self.BITS
+        if shift <= 0:
+            self.counts[value] += 1
+        else:
+            self.counts[shift * self.HALF + (value >> shift)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def bucket_value(self, index):
+        if index < 2 * self.HALF:
+            return index
+        shift = index // self.HALF - 1
+        return (index - shift * self.HALF) << shift
+
+    def percentile(self, q):
+        """Значение (нс), ниже которого лежит доля q записей."""
+        if not self.count:
+            return 0
+        target = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= target:
+                return self.bucket_value(index)
+        return self.max
+
+
+LATENCY_STAGES = ("parse", "book_update", "shm_handoff", "evaluate", "tick_to_order", "order_ack", "order_fill", "tick_to_trade")
+latency = {stage: LatencyHistogram() for stage in LATENCY_STAGES}
+last_tick_ns = 0  # Время приёма кадра, который сейчас обрабатывается (для связи тика с ордером)
+
+def record_latency(stage, start_ns):
+    """Записывает задержку от `start_ns` до текущего момента и возвращает текущее время (нс)."""
+    now = time.perf_counter_ns()
+    if LATENCY_METRICS and start_ns:
+        latency[stage].record(now - start_ns)
+    return now
+
+def latency_report():
+    """Короткая сводка по всем этапам в микросекундах."""
+    lines = []
+    for stage, histogram in latency.items():
+        if histogram.count:
+            lines.append(
+                f"{stage}: n={histogram.count} p50={histogram.percentile(0.5) / 1e3:.1f} "
+                f"p90={histogram.percentile(0.9) / 1e3:.1f} p99={histogram.percentile(0.99) / 1e3:.1f} "
+                f"max={histogram.max / 1e3:.1f} мкс"
+            )
+    return lines
+
+def prometheus_metrics():
+    """Гистограммы задержек в текстовом формате Prometheus (summary)."""
+    lines = ["# HELP okx_bot_latency_seconds Задержка этапов обработки тика", "# TYPE okx_bot_latency_seconds summary"]
+    for stage, histogram in latency.items():
+        for q in (0.5, 0.9, 0.99, 0.999):
+            lines.append(f'okx_bot_latency_seconds{{stage="{stage}",quantile="{q}"}} {histogram.percentile(q) / 1e9:.9f}')
+        lines.append(f'okx_bot_latency_seconds_sum{{stage="{stage}"}} {histogram.total / 1e9:.9f}')
+        lines.append(f'okx_bot_latency_seconds_count{{stage="{stage}"}} {histogram.count}')
+    lines.append("# HELP okx_bot_persistence Очередь и пакеты фоновой записи в SQLite")
+    lines.append("# TYPE okx_bot_persistence gauge")
+    for key, value in persistence.stats().items():
+        lines.append(f'okx_bot_persistence{{metric="{key}"}} {value}')
+    lines.append("# HELP okx_bot_runtime Состояние рантайма: задержка цикла, перезапуски задач, здоровье")
+    lines.append("# TYPE okx_bot_runtime gauge")
+    for key, value in runtime.stats().items():
+        lines.append(f'okx_bot_runtime{{metric="{key}"}} {value}')
+    for name, count in runtime.restarts.items():
+        lines.append(f'okx_bot_runtime{{metric="restarts",task="{name}"}} {count}')
+    lines.append("# HELP okx_bot_opportunities Очередь возможностей: в очереди, исполняются, опубликовано, протухло")
+    lines.append("# TYPE okx_bot_opportunities gauge")
+    for key, value in opportunities.stats().items():
+        lines.append(f'okx_bot_opportunities{{metric="{key}"}} {value}')
+    if INVENTORY_TARGETS:
+        lines.append("# HELP okx_bot_inventory Запас валют параллельного режима: баланс, цель и полоса")
+        lines.append("# TYPE okx_bot_inventory gauge")
+        for currency, target in INVENTORY_TARGETS.items():
+            low, high = inventory_band(currency)
+            balance = balances.get(currency, (0.0, 0.0))[0]
+            for kind, value in (("balance", balance), ("target", target), ("low", low), ("high", high)):
+                lines.append(f'okx_bot_inventory{{currency="{currency}",kind="{kind}"}} {value}')
+    return "\n".join(lines) + "\n"
+
+async def serve_metrics(port=METRICS_PORT):
+    """Локальный HTTP-эндпоинт /metrics для Prometheus."""
+    async def handle(reader, writer):
+        await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        body = prometheus_metrics().encode()
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                     + f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+        writer.close()
+
+    server = await asyncio.start_server(handle, "127.0.0.1", port)
+    async with server:
+        await server.serve_forever()
+
+# Периодическая запись гистограмм задержек и счётчиков в лог
+def dump_metrics():
+    for line in latency_report():
+        logging.error(f"⏱️ {line}")
+    stats = persistence.stats()
+    logging.error(f"💾 БД: очередь {stats['queue_depth']} (макс. {stats['max_queue_depth']}), записано {stats['written_rows']} "
+                  f"строк в {stats['batches']} пакетах, отброшено {stats['dropped']}, ошибок {stats['errors']}")
+    stats = opportunities.stats()
+    logging.error(f"🎯 Возможности: опубликовано {stats['published']}, протухло {stats['stale']}, "
+                  f"пропущено во время исполнения {stats['skipped_in_flight']}")
+    for line in inventory_report():
+        logging.error(f"📦 {line}")
+
+
+# In-memory хранилище котировок (вместо UPDATE tab_2 на каждый тик)
+class QuoteStore:
+    """Лучшие цены и объёмы по инструментам в компактных массивах, индекс — по instId."""
+
+    def __init__(self):
+        self.index = {}  # instId -> номер строки в массивах
+        self.pairs = []
+        self.bid = array("d")
+        self.ask = array("d")
+        self.bid_volume = array("d")
+        self.ask_volume = array("d")
+        self.updated_at = array("d")  # time.monotonic() последнего обновления
+
+    def register(self, pairs):
+        """Один раз размечает массивы под список инструментов (NaN = нет данных)."""
+        self.pairs = list(dict.fromkeys(pairs))
+        self.index = {pair: i for i, pair in enumerate(self.pairs)}
+        empty = [math.nan] * len(self.pairs)
+        self.bid = array("d", empty)
+        self.ask = array("d", empty)
+        self.bid_volume = array("d", empty)
+        self.ask_volume = array("d", empty)
+        self.updated_at = array("d", empty)
+
+    def add(self, pairs):
+        """Дописывает строки для новых инструментов, не сдвигая старые. Возвращает отслеживаемые из `pairs`."""
+        pairs = list(dict.fromkeys(pairs))
+        new = [pair for pair in pairs if pair not in self.index]
+        if new:
+            # Новые массивы вместо append: на старые смотрят NumPy-представления `TriangleEngine`,
+            # а массив с экспортированным буфером не растёт (BufferError). Индекс — после столбцов.
+            tail = array("d", [math.nan]) * len(new)
+            self.bid, self.ask, self.bid_volume, self.ask_volume, self.updated_at = (
+                column + tail for column in (self.bid, self.ask, self.bid_volume, self.ask_volume, self.updated_at)
+            )
+            for pair in new:
+                self.index[pair] = len(self.pairs)
+                self.pairs.append(pair)
+        return pairs
+
+    def update(self, pair, bid_price, ask_price, bid_volume, ask_volume, received_ns=0):
+        """Записывает верх стакана. Возвращает индекс инструмента или -1, если он не отслеживается."""
+        i = self.index.get(pair, -1)
+        if i < 0:
+            return -1
+        self.bid[i] = bid_price
+        self.ask[i] = ask_price
+        self.bid_volume[i] = bid_volume
+        self.ask_volume[i] = ask_volume
+        self.updated_at[i] = time.monotonic()
+        return i
+
+    def update_book(self, pair, book, received_ns=0):
+        """Записывает верх локального стакана `OrderBook` (обе стороны не пусты)."""
+        bid_price, bid_volume = book.best_bid()
+        ask_price, ask_volume = book.best_ask()
+        return self.update(pair, bid_price, ask_price, bid_volume, ask_volume)
+
+    def invalidate(self, pair):
+        """Помечает котировку инструмента как отсутствующую (например, при рассинхронизации стакана)."""
+        i = self.index.get(pair, -1)
+        if i >= 0:
+            self.bid[i] = self.ask[i] = self.bid_volume[i] = self.ask_volume[i] = math.nan
+
+    def book(self, pair):
+        """Только верх стакана (инструменты на `bbo-tbt`); глубина остальных — в `order_books`."""
+        bid, ask, bid_volume, ask_volume = self.get(pair)
+        if None in (bid, ask, bid_volume, ask_volume):
+            return None
+        return BookLevels([(bid, bid_volume)], [(ask, ask_volume)])
+
+    def get(self, pair):
+        """Возвращает (bid, ask, bid_volume, ask_volume), None вместо отсутствующих значений."""
+        i = self.index.get(pair, -1)
+        if i < 0:
+            return None, None, None, None
+        # Горячий путь оценки треугольников: без генератора, NaN — единственное значение, не равное себе
+        bid, ask, bid_volume, ask_volume = self.bid[i], self.ask[i], self.bid_volume[i], self.ask_volume[i]
+        return (bid if bid == bid else None, ask if ask == ask else None,
+                bid_volume if bid_volume == bid_volume else None, ask_volume if ask_volume == ask_volume else None)
+
+
+# Снимок верхних уровней стакана из общей памяти (для расчёта объёма сделки)
+class BookLevels:
+    """Тот же интерфейс чтения, что у `OrderBook`: уровни от лучшего к худшему."""
+
+    def __init__(self, bids, asks):
+        self._bids = bids
+        self._asks = asks
+
+    def bids(self, depth=None):
+        return self._bids[:depth]
+
+    def asks(self, depth=None):
+        return self._asks[:depth]
+
+
+def attach_shared_memory(name):
+    """Подключается к чужому блоку общей памяти, не передавая его resource_tracker этого процесса."""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13: шарды запускает владелец блока, и resource_tracker у них общий — повторная
+        # регистрация ничего не меняет, а unregister снял бы и регистрацию владельца
+        return shared_memory.SharedMemory(name=name)
+
+
+# Котировки и глубина в общей памяти: шарды пишут, процесс-оценщик читает без копирования
+class SharedQuoteStore(QuoteStore):
+    """Столбцы `QuoteStore` плюс `SHARED_BOOK_DEPTH` уровней стакана в `multiprocessing.shared_memory`.
+
+    Каждую строку пишет ровно один процесс-шард. Согласованность — seqlock: счётчик строки нечётный,
+    пока идёт запись, и читатель повторяет чтение, если счётчик изменился. `TriangleEngine` читает
+    столбцы без блокировки, прибыльные строки перепроверяются при исполнении."""
+
+    def __init__(self, name=None, depth=SHARED_BOOK_DEPTH):
+        super().__init__()
+        self.owner = name is None  # Владелец создаёт и удаляет блок, шарды только подключаются
+        self.name = name
+        self.depth = depth
+        self.shm = None
+
+    def register(self, pairs):
+        """Размечает блок под список инструментов; шарды вызывают с тем же списком в том же порядке."""
+        self.close()
+        self.pairs = list(dict.fromkeys(pairs))
+        self.index = {pair: i for i, pair in enumerate(self.pairs)}
+        n, d = len(self.pairs), self.depth
+        size = 8 * (7 * n + 4 * n * d)
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=max(size, 8))
+            self.name = self.shm.name
+        else:
+            self.shm = attach_shared_memory(self.name)
+
+        offset = 0
+        def column(fmt, length):
+            nonlocal offset
+            view = self.shm.buf[offset:offset + 8 * length].cast(fmt)
+            offset += 8 * length
+            return view
+
+        self.seq = column("q", n)  # Счётчик seqlock строки
+        self.received_ns = column("q", n)  # time.perf_counter_ns() приёма кадра (CLOCK_MONOTONIC, общий для процессов)
+        self.bid, self.ask, self.bid_volume, self.ask_volume, self.updated_at = (column("d", n) for _ in range(5))
+        self.bid_prices, self.bid_sizes, self.ask_prices, self.ask_sizes = (column("d", n * d) for _ in range(4))
+        if self.owner:
+            for view in (self.bid, self.ask, self.bid_volume, self.ask_volume, self.updated_at):
+                view[:] = array("d", [math.nan]) * n
+            for view in (self.bid_prices, self.bid_sizes, self.ask_prices, self.ask_sizes):
+                view[:] = array("d", [math.nan]) * (n * d)
+
+    def add(self, pairs):
+        """Блок общей памяти фиксированного размера: новые инструменты не добавляются."""
+        pairs = list(dict.fromkeys(pairs))
+        missing = [pair for pair in pairs if pair not in self.index]
+        if missing:
+            logging.error(f"⚠️ Нет места в общей памяти, инструменты не отслеживаются: {', '.join(missing)}")
+        return [pair for pair in pairs if pair in self.index]
+
+    def close(self):
+        """Отключается от блока; владелец ещё и удаляет его."""
+        if self.shm is None:
+            return
+        if self.owner:
+            self.shm.unlink()
+        try:
+            self.shm.close()
+        except BufferError:
+            # На блок ещё смотрят массивы NumPy (оценщик работает до выхода процесса): оставляем ссылку,
+            # иначе `SharedMemory.__del__` повторит close и напечатает ту же ошибку при сборке мусора
+            return
+        self.shm = None
+
+    def update(self, pair, bid_price, ask_price, bid_volume, ask_volume, received_ns=0):
+        i = self.index.get(pair, -1)
+        if i < 0:
+            return -1
+        lo = i * self.depth
+        self.seq[i] += 1
+        self.bid[i] = self.bid_prices[lo] = bid_price
+        self.ask[i] = self.ask_prices[lo] = ask_price
+        self.bid_volume[i] = self.bid_sizes[lo] = bid_volume
+        self.ask_volume[i] = self.ask_sizes[lo] = ask_volume
+        if self.depth > 1:
+            self.bid_prices[lo + 1] = self.ask_prices[lo + 1] = math.nan  # Глубже верха данных нет
+        self.updated_at[i] = time.monotonic()
+        self.received_ns[i] = received_ns
+        self.seq[i] += 1
+        return i
+
+    def update_book(self, pair, book, received_ns=0):
+        """Публикует верх и `depth` уровней каждой стороны стакана одной записью под seqlock."""
+        i = self.index.get(pair, -1)
+        if i < 0:
+            return -1
+        d = self.depth
+        stop = -d - 1
+        bid_prices = array("d", book.bid_keys[:stop:-1])
+        bid_sizes = array("d", book.bid_sizes[:stop:-1])
+        ask_prices = array("d", (-key for key in book.ask_keys[:stop:-1]))
+        ask_sizes = array("d", book.ask_sizes[:stop:-1])
+        pad = array("d", [math.nan])
+        lo, hi = i * d, (i + 1) * d
+
+        self.seq[i] += 1
+        self.bid[i], self.bid_volume[i] = bid_prices[0], bid_sizes[0]
+        self.ask[i], self.ask_volume[i] = ask_prices[0], ask_sizes[0]
+        self.bid_prices[lo:hi] = bid_prices + pad * (d - len(bid_prices))
+        self.bid_sizes[lo:hi] = bid_sizes + pad * (d - len(bid_sizes))
+        self.ask_prices[lo:hi] = ask_prices + pad * (d - len(ask_prices))
+        self.ask_sizes[lo:hi] = ask_sizes + pad * (d - len(ask_sizes))
+        self.updated_at[i] = time.monotonic()
+        self.received_ns[i] = received_ns
+        self.seq[i] += 1
+        return i
+
+    def invalidate(self, pair):
+        i = self.index.get(pair, -1)
+        if i >= 0:
+            self.seq[i] += 1
+            self.bid[i] = self.ask[i] = self.bid_volume[i] = self.ask_volume[i] = math.nan
+            self.bid_prices[i * self.depth] = self.ask_prices[i * self.depth] = math.nan
+            self.seq[i] += 1
+
+    def read_consistent(self, i, read):
+        """Вызывает `read(i)`, пока строку не удастся прочитать между двумя одинаковыми чётными счётчиками."""
+        for _ in range(SEQLOCK_RETRIES):
+            seq = self.seq[i]
+            if seq & 1:
+                continue
+            values = read(i)
+            if self.seq[i] == seq:
+                return values
+        return None  # Шард завис посреди записи — считаем, что данных нет
+
+    def get(self, pair):
+        i = self.index.get(pair, -1)
+        values = None
+        if i >= 0:
+            values = self.read_consistent(i, lambda i: (self.bid[i], self.ask[i], self.bid_volume[i], self.ask_volume[i]))
+        if values is None:
+            return None, None, None, None
+        return tuple(None if math.isnan(value) else value for value in values)
+
+    def book(self, pair):
+        """Снимок верхних уровней стакана или None, если данных нет."""
+        i = self.index.get(pair, -1)
+        if i < 0:
+            return None
+        lo, hi = i * self.depth, (i + 1) * self.depth
+        levels = self.read_consistent(i, lambda i: (
+            self.bid_prices[lo:hi].tolist(), self.bid_sizes[lo:hi].tolist(),
+            self.ask_prices[lo:hi].tolist(), self.ask_sizes[lo:hi].tolist(),
+        ))
+        if levels is None or math.isnan(levels[0][0]) or math.isnan(levels[2][0]):
+            return None
+        bid_prices, bid_sizes, ask_prices, ask_sizes = levels
+        return BookLevels(self.levels(bid_prices, bid_sizes), self.levels(ask_prices, ask_sizes))
+
+    @staticmethod
+    def levels(prices, sizes):
+        """Уровни до первого NaN: глубже него лежат устаревшие данные."""
+        result = []
+        for price, size in zip(prices, sizes):
+            if math.isnan(price):
+                break
+            result.append((price, size))
+        return result
+
+
+# Локальный стакан инструмента: снимок + инкрементальные обновления канала `books`
+class OrderBook:
+    """Уровни хранятся в отсортированных массивах так, что лучшая цена всегда в конце списка.
+    Исходные строки цены и объёма (для контрольной суммы) — в параллельных списках, без кортежа на уровень."""
+
+    def __init__(self, pair):
+        self.pair = pair
+        self.reset()
+
+    def reset(self):
+        self.seq_id = None  # None — стакан не синхронизирован, ждём снимок
+        # Ключи: bid — цена по возрастанию, ask — минус цена по возрастанию (лучший ask тоже в конце)
+        self.bid_keys, self.bid_sizes, self.bid_px, self.bid_sz = [], [], [], []
+        self.ask_keys, self.ask_sizes, self.ask_px, self.ask_sz = [], [], [], []
+
+    def best_bid(self):
+        """(цена, объём) лучшего bid или None."""
+        return (self.bid_keys[-1], self.bid_sizes[-1]) if self.bid_keys else None
+
+    def best_ask(self):
+        """(цена, объём) лучшего ask или None."""
+        return (-self.ask_keys[-1], self.ask_sizes[-1]) if self.ask_keys else None
+
+    def bids(self, depth=None):
+        """Уровни bid от лучшего к худшему: [(цена, объём), ...]."""
+        stop = None if depth is None else -depth - 1
+        return list(zip(self.bid_keys[:stop:-1], self.bid_sizes[:stop:-1]))
+
+    def asks(self, depth=None):
+        """Уровни ask от лучшего к худшему: [(цена, объём), ...]."""
+        stop = None if depth is None else -depth - 1
+        return [(-key, size) for key, size in zip(self.ask_keys[:stop:-1], self.ask_sizes[:stop:-1])]
+
+    def raw_bids(self, depth=None):
+        """Исходные строки bid от лучшего к худшему: [(цена, объём), ...]."""
+        stop = None if depth is None else -depth - 1
+        return list(zip(self.bid_px[:stop:-1], self.bid_sz[:stop:-1]))
+
+    def raw_asks(self, depth=None):
+        """Исходные строки ask от лучшего к худшему: [(цена, объём), ...]."""
+        stop = None if depth is None else -depth - 1
+        return list(zip(self.ask_px[:stop:-1], self.ask_sz[:stop:-1]))
+
+    def apply(self, action, data):
+        """Применяет снимок или обновление. Возвращает False при разрыве seqId или неверной контрольной сумме."""
+        if action == "snapshot":
+            self.reset()
+            # bid приходят от лучшего к худшему (по убыванию цены), ask — по возрастанию цены
+            bids, asks = data.get("bids", [])[::-1], data.get("asks", [])[::-1]
+            self.bid_px = [level[0] for level in bids]
+            self.bid_sz = [level[1] for level in bids]
+            self.bid_keys = list(map(float, self.bid_px))
+            self.bid_sizes = list(map(float, self.bid_sz))
+            self.ask_px = [level[0] for level in asks]
+            self.ask_sz = [level[1] for level in asks]
+            self.ask_keys = [-float(px) for px in self.ask_px]
+            self.ask_sizes = list(map(float, self.ask_sz))
+        else:
+            if self.seq_id is None or data.get("prevSeqId") != self.seq_id:
+                self.reset()
+                return False
+            self._apply_side(self.bid_keys, self.bid_sizes, self.bid_px, self.bid_sz, data.get("bids", ()), 1.0)
+            self._apply_side(self.ask_keys, self.ask_sizes, self.ask_px, self.ask_sz, data.get("asks", ()), -1.0)
+
+        if BOOK_CHECKSUM and "checksum" in data and self.checksum() != data["checksum"]:
+            self.reset()
+            return False
+        self.seq_id = data.get("seqId")
+        return True
+
+    @staticmethod
+    def _apply_side(keys, sizes, prices, raw_sizes, levels, sign):
+        # Бинарный поиск каждого уровня: обновляем, удаляем (объём 0) или вставляем новый
+        n = len(keys)
+        for level in levels:
+            px, sz = level[0], level[1]
+            key = sign * float(px)
+            size = float(sz)
+            i = bisect_left(keys, key)
+            if i != n and keys[i] == key:
+                if size == 0:
+                    del keys[i], sizes[i], prices[i], raw_sizes[i]
+                    n -= 1
+                else:
+                    sizes[i] = size
+                    raw_sizes[i] = sz
+            elif size != 0:
+                keys.insert(i, key)
+                sizes.insert(i, size)
+                prices.insert(i, px)
+                raw_sizes.insert(i, sz)
+                n += 1
+
+    def checksum(self):
+        """CRC32 OKX: по 25 лучших уровней, чередуя bid:ask, как знаковое 32-битное число."""
+        bid_px, bid_sz = self.bid_px[:-26:-1], self.bid_sz[:-26:-1]
+        ask_px, ask_sz = self.ask_px[:-26:-1], self.ask_sz[:-26:-1]
+        if len(bid_px) == len(ask_px):
+            parts = map(":".join, zip(bid_px, bid_sz, ask_px, ask_sz))
+        else:
+            parts = []
+            for k in range(max(len(bid_px), len(ask_px))):
+                if k < len(bid_px):
+                    parts += bid_px[k], bid_sz[k]
+                if k < len(ask_px):
+                    parts += ask_px[k], ask_sz[k]
+        crc = zlib.crc32(":".join(parts).encode())
+        return crc - (1 << 32) if crc >= 1 << 31 else crc
+
+
+order_books = {}  # instId -> OrderBook
+quote_store = QuoteStore()  # Общее хранилище для WebSocket-обработчиков, анализа и арбитража
+triangles = []  # Список треугольников (pair1, pair2, pair3) после фильтрации
+pair_triangles = {}  # Обратный индекс: инструмент -> номера треугольников, где он участвует
+triangle_engine = None  # Пакетный расчёт на NumPy (если установлен)
+cycle_detector = None  # Детектор отрицательных циклов (STRATEGY_MODE = "negative_cycles")
+evaluate_on_tick = True  # False в процессах-шардах: они только публикуют котировки в общую память
+ingest_workers = []  # [процесс, номер шарда, инструменты] при INGEST_WORKERS > 0
+watcher_thread = None  # Поток shared_quote_watcher при INGEST_WORKERS > 0
+watcher_stop = threading.Event()  # Останавливает shared_quote_watcher до закрытия цикла событий
+
+# Передача найденных возможностей из потока WebSocket в цикл исполнения
+class OpportunityQueue:
+    """Очередь с приоритетом по финальному балансу: одна запись на треугольник (новая строка заменяет
+    старую), записи, оценённые раньше чем `ttl` назад, отбрасываются, исполняемые треугольники заблокированы.
+    Возраст считается от оценки, а не от последнего изменения цены: тихий, но живой стакан не устаревает,
+    а котировки упавшего соединения сбрасываются, и по ним возможность просто не находится."""
+
+    def __init__(self, ttl=OPPORTUNITY_TTL):
+        self.ttl = ttl
+        self.heap = []  # (-финальный баланс, версия, ключ); устаревшие версии пропускаются при извлечении
+        self.entries = {}  # ключ треугольника -> (строка формата tab_3, время тика, время оценки, версия)
+        self.in_flight = set()
+        self.version = 0
+        self.closed = False  # При остановке новые возможности не выдаются
+        self.lock = threading.Lock()
+        self.loop = None
+        self.event = None  # asyncio.Event цикла исполнения
+        # Метрики
+        self.published = 0
+        self.stale = 0
+        self.skipped_in_flight = 0
+
+    def bind(self, loop):
+        """Привязывает очередь к циклу исполнения (вызывается в нём)."""
+        self.event = asyncio.Event()
+        self.loop = loop
+
+    def publish(self, key, row, tick_ns):
+        """Добавляет или обновляет возможность; True, если треугольника в очереди ещё не было."""
+        evaluated_at = time.monotonic()
+        with self.lock:
+            if key in self.in_flight:
+                self.skipped_in_flight += 1
+                return False
+            is_new = key not in self.entries
+            self.version += 1
+            self.entries[key] = (row, tick_ns, evaluated_at, self.version)
+            heapq.heappush(self.heap, (-row[-1], self.version, key))
+            if len(self.heap) > 2 * len(self.entries) + 64:
+                # Пока исполнитель занят, обновления копят устаревшие версии — пересобираем кучу
+                self.heap = [(-entry[0][-1], entry[3], k) for k, entry in self.entries.items()]
+                heapq.heapify(self.heap)
+            self.published += 1
+        if is_new and self.loop is not None:
+            self.loop.call_soon_threadsafe(self.event.set)
+        return is_new
+
+    def discard(self, key):
+        """Возможность исчезла до исполнения."""
+        if key in self.entries:
+            with self.lock:
+                self.entries.pop(key, None)
+
+    def take(self):
+        """Лучшая свежая возможность как (ключ, строка, время тика) или None; треугольник блокируется."""
+        now = time.monotonic()
+        with self.lock:
+            while self.heap and not self.closed:
+                _, version, key = heapq.heappop(self.heap)
+                entry = self.entries.get(key)
+                if entry is None or entry[3] != version:
+                    continue
+                del self.entries[key]
+                if now - entry[2] > self.ttl:
+                    self.stale += 1
+                    continue
+                self.in_flight.add(key)
+                return key, entry[0], entry[1]
+            self.event.clear()
+        return None
+
+    async def next(self):
+        """Ждёт и возвращает лучшую свежую возможность."""
+        while True:
+            item = self.take()
+            if item is not None:
+                return item
+            await self.event.wait()
+
+    def close(self):
+        """Перестаёт выдавать возможности; исполняемые сейчас доходят до конца."""
+        with self.lock:
+            self.closed = True
+
+    def release(self, key):
+        """Снимает блокировку после исполнения (успешного или нет)."""
+        with self.lock:
+            self.in_flight.discard(key)
+
+    def stats(self):
+        return {
+            "queued": len(self.entries), "in_flight": len(self.in_flight), "published": self.published,
+            "stale": self.stale, "skipped_in_flight": self.skipped_in_flight,
+        }
+
+
+opportunities = OpportunityQueue()
 
 # Функция для запроса торговых пар у OKX
-def fetch_trading_pairs():
-    """Запрашивает торговые пары у OKX и загружает их в `tab_1`."""
+# Параметры инструментов: кэш в SQLite с TTL и отпечатком списка вместо запроса на каждом старте
+Instrument = namedtuple("Instrument", "inst_id base quote tick_sz lot_sz min_sz state")
+instruments = {}  # instId -> Instrument
+http_session = requests.Session()  # Одно keep-alive соединение для REST-запросов
+
+def cache_get(key):
+    with sqlite3.connect("arbitrage.db") as conn:
+        row = conn.execute("SELECT value FROM cache_meta WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else None
+
+def cache_set(conn, **values):
+    conn.executemany("INSERT OR REPLACE INTO cache_meta (key, value) VALUES (?, ?)", [(k, str(v)) for k, v in values.items()])
+
+def instruments_digest(items):
+    """Отпечаток списка инструментов (аналог ETag): меняется только при изменении значимых полей."""
+    return hashlib.sha1(repr(sorted(items)).encode()).hexdigest()
+
+def load_instruments():
+    """Заполняет `instruments` из кэша, а если он устарел — с биржи. Возвращает True, если список изменился."""
+    global instruments
+    with sqlite3.connect("arbitrage.db") as conn:
+        cached = [Instrument(*row) for row in conn.execute("SELECT * FROM instruments")]
+    fetched_at = float(cache_get("instruments_fetched_at") or 0)
+    if cached and time.time() - fetched_at < INSTRUMENT_CACHE_TTL:
+        instruments = {item.inst_id: item for item in cached}
+        precisions.clear()
+        return False
+
     logging.info("Запрос торговых пар у OKX")
-    response = requests.get(f"{OKX_API_URL}/public/instruments?instType=SPOT")
-    data = response.json()
-    
+    try:
+        response = http_session.get(f"{OKX_API_URL}/public/instruments", params={"instType": "SPOT"}, timeout=10)
+        data = response.json()
+    except (requests.RequestException, ValueError) as e:
+        data = {"error": str(e)}
     if "data" not in data:
-        logging.error("Ошибка при получении данных о торговых парах")
-        return []
-    
-    pairs = [(item["instId"], None, None) for item in data["data"]]
-
+        logging.error(f"Ошибка при получении данных о торговых парах: {data.get('msg') or data.get('error')}")
+        instruments = {item.inst_id: item for item in cached}  # Лучше устаревший список, чем никакого
+        precisions.clear()
+        return False
+
+    fresh = [
+        Instrument(item["instId"], item.get("baseCcy", ""), item.get("quoteCcy", ""), item.get("tickSz", ""),
+                   item.get("lotSz", ""), item.get("minSz", ""), item.get("state", "live"))
+        for item in data["data"]
+    ]
+    digest = instruments_digest(fresh)
+    changed = digest != cache_get("instruments_digest")
     with sqlite3.connect("arbitrage.db") as conn:
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM tab_1")
-        cursor.executemany("INSERT INTO tab_1 (pair, bid_price, ask_price) VALUES (?, ?, ?)", pairs)
-        conn.commit()
+        if changed:
+            conn.execute("DELETE FROM instruments")
+            conn.executemany("INSERT INTO instruments VALUES (?, ?, ?, ?, ?, ?, ?)", fresh)
+        cache_set(conn, instruments_fetched_at=time.time(), instruments_digest=digest)
+    instruments = {item.inst_id: item for item in fresh}
+    precisions.clear()
+    return changed
+
+def fetch_trading_pairs():
+    """Обновляет параметры инструментов и загружает торгуемые пары в `tab_1` (только если список изменился)."""
+    changed = load_instruments()
+    pairs = [item.inst_id for item in instruments.values() if item.state == "live"]
+    if changed:
+        with sqlite3.connect("arbitrage.db") as conn:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM tab_1")
+            cursor.executemany("INSERT INTO tab_1 (pair, bid_price, ask_price) VALUES (?, ?, ?)", [(p, None, None) for p in pairs])
+            conn.commit()
+        print("✅ Валютные пары загружены в tab_1.")
+    else:
+        print("✅ Список валютных пар не изменился, tab_1 актуальна.")
+    return pairs
+
+# Точность цен и размеров по правилам инструмента (tickSz, lotSz, minSz) в целых числах без float-ошибок
+def decimal_units(text):
+    """'0.0005' -> (5, 4): число единиц и знаков после точки, без float и Decimal."""
+    whole, _, fraction = text.strip().partition(".")
+    fraction = fraction.rstrip("0")
+    return int((whole + fraction).lstrip("0") or "0"), len(fraction)
+
+
+class Precision:
+    """Шаги цены и размера инструмента как целые числа единиц 10^-знаков: округление за O(1)."""
+
+    __slots__ = ("tick", "tick_decimals", "lot", "lot_decimals", "min_size")
+
+    def __init__(self, tick_sz, lot_sz, min_sz):
+        self.tick, self.tick_decimals = decimal_units(tick_sz)
+        self.lot, self.lot_decimals = decimal_units(lot_sz)
+        min_units, min_decimals = decimal_units(min_sz)
+        # Минимальный размер в единицах лота (с округлением вверх, если у minSz больше знаков)
+        shift = self.lot_decimals - min_decimals
+        self.min_size = min_units * 10 ** shift if shift >= 0 else -(-min_units // 10 ** -shift)
+
+    @staticmethod
+    def scaled(value, decimals):
+        """value × 10^decimals; целое, если отличается от него лишь ошибкой представления float (допуск относительный)."""
+        units = value * 10 ** decimals
+        nearest = round(units)
+        return nearest if math.isclose(units, nearest, rel_tol=1e-12) else units
+
+    @staticmethod
+    def floor_units(value, decimals, step):
+        units = math.floor(Precision.scaled(value, decimals))
+        return units - units % step
+
+    @staticmethod
+    def format(units, decimals):
+        if decimals == 0:
+            return str(units)
+        scale = 10 ** decimals
+        return f"{units // scale}.{units % scale:0{decimals}d}"
+
+    def round_size(self, size):
+        """Размер в базовой валюте вниз до lotSz; None, если меньше minSz."""
+        units = self.floor_units(size, self.lot_decimals, self.lot)
+        return self.format(units, self.lot_decimals) if units >= self.min_size and units > 0 else None
+
+    def round_price(self, price, up=False):
+        """Цена до tickSz: вниз для покупки, вверх (`up=True`) для продажи."""
+        if not up:
+            return self.format(self.floor_units(price, self.tick_decimals, self.tick), self.tick_decimals)
+        units = math.ceil(self.scaled(price, self.tick_decimals))
+        return self.format(-(-units // self.tick) * self.tick, self.tick_decimals)
+
+    def round_notional(self, amount, price):
+        """Сумма рыночной покупки в валюте котировки: шаг tickSz × lotSz; None, если на неё не купить minSz."""
+        decimals = self.tick_decimals + self.lot_decimals
+        units = self.floor_units(amount, decimals, self.tick * self.lot)
+        if units <= 0 or (price and amount / price * 10 ** self.lot_decimals < self.min_size - 1e-9):
+            return None
+        return self.format(units, decimals)
+
+
+precisions = {}  # instId -> Precision, строится при первом обращении
+
+def precision_for(pair):
+    precision = precisions.get(pair)
+    if precision is None:
+        item = instruments.get(pair)
+        if item is None or not (item.tick_sz and item.lot_sz and item.min_sz):
+            return None
+        precision = precisions[pair] = Precision(item.tick_sz, item.lot_sz, item.min_sz)
+    return precision
+
+def order_size(pair, side, amount, price=None):
+    """Значение `sz` рыночного ордера по правилам инструмента или None, если биржа его отклонит.
+    buy — сумма в валюте котировки (`price` — ожидаемая цена для проверки minSz), sell — количество базовой валюты."""
+    precision = precision_for(pair)
+    if precision is None:
+        logging.error(f"⚠️ Нет параметров инструмента {pair} (tickSz/lotSz/minSz), ордер не отправляем")
+        return None
+    return precision.round_notional(amount, price) if side == "buy" else precision.round_size(amount)
+
+
+# Граф валют: соседи хранятся множествами, инструменты ищутся по паре валют за O(1)
+pair_map = {}  # валюта -> множество валют, с которыми есть торговая пара
+pair_lookup = {}  # (валюта1, валюта2) -> instId, прямое направление в приоритете
+
+def build_currency_graph(pairs):
+    """Заполняет `pair_map` и `pair_lookup` по списку инструментов без исключённых валют."""
+    global pair_map, pair_lookup
+    pair_map = {}
+    pair_lookup = {}
+    add_to_currency_graph(pairs)
+    return pair_map, pair_lookup
+
+def add_to_currency_graph(pairs):
+    """Дописывает инструменты в `pair_map` и `pair_lookup` (исключённые валюты пропускаются)."""
+    for pair in pairs:
+        base, quote = pair.split("-")
+        if base in EXCLUDED_CURRENCIES or quote in EXCLUDED_CURRENCIES:
+            continue  # Пропускаем запрещённые валюты
+        pair_map.setdefault(base, set()).add(quote)
+        pair_map.setdefault(quote, set()).add(base)
+        pair_lookup[(base, quote)] = pair
+        pair_lookup.setdefault((quote, base), pair)
+
+def find_cycles(length, anchors=TARGET_CURRENCIES_DEF):
+    """Перечисляет циклы v1 → … → anchor → v1 длины `length`, проходя только по реальным рёбрам графа."""
+    for anchor in anchors:
+        if anchor not in pair_map:
+            continue
+        anchor_neighbors = pair_map[anchor]
+        path = []
+
+        def walk(currency):
+            path.append(currency)
+            if len(path) == length - 1:
+                # Последняя промежуточная валюта должна быть связана с якорем
+                yield (*path, anchor)
+            else:
+                neighbors = pair_map[currency]
+                if len(path) == length - 2:
+                    neighbors = neighbors & anchor_neighbors
+                for nxt in neighbors:
+                    if nxt != anchor and nxt not in path:
+                        yield from walk(nxt)
+            path.pop()
 
-    print("✅ Валютные пары загружены в tab_1.")
-    return [p[0] for p in pairs]
+        for first in anchor_neighbors:
+            yield from walk(first)
+
+def cycle_pairs(cycle):
+    """Переводит цикл валют в список инструментов для каждого шага (последний шаг — обратно к первой валюте)."""
+    return tuple(pair_lookup[(cycle[k], cycle[(k + 1) % len(cycle)])] for k in range(len(cycle)))
 
 def find_triangular_arbitrage():
     """Находит возможные треугольники для арбитража и загружает их в tab_2."""
     conn = sqlite3.connect("arbitrage.db")  # ✅ Открываем соединение
     cursor = conn.cursor()
     cursor.execute("DELETE FROM tab_2")
+    cursor.execute("DELETE FROM cycles")
     cursor.execute("SELECT pair FROM tab_1")
     pairs = [row[0] for row in cursor.fetchall()]
 
-    currencies = set()
-    pair_map = {}
-
     # Заполняем связи валют
-    for pair in pairs:
-        base, quote = pair.split("-")
-        if base in EXCLUDED_CURRENCIES or quote in EXCLUDED_CURRENCIES:
-            continue  # Пропускаем запрещённые валюты
-        currencies.update([base, quote])
-        pair_map.setdefault(base, []).append(quote)
-        pair_map.setdefault(quote, []).append(base)
-
-    triangles = []
-
-    # Поиск треугольников
-    for a, b, c in permutations(currencies, 3):
-        if b in pair_map[a] and c in pair_map[b] and a in pair_map[c] and c in TARGET_CURRENCIES_DEF:
-            pair1 = f"{a}-{b}" if f"{a}-{b}" in pairs else f"{b}-{a}"
-            pair2 = f"{b}-{c}" if f"{b}-{c}" in pairs else f"{c}-{b}"
-            pair3 = f"{c}-{a}" if f"{c}-{a}" in pairs else f"{a}-{c}"
-            
-            if not (pair1 in pairs and pair2 in pairs and pair3 in pairs):
-                continue
-            
-            triangles.append((pair1, pair2, pair3))
+    build_currency_graph(pairs)
+
+    # Поиск треугольников: a → b → c → a, где c — валюта из TARGET_CURRENCIES_DEF
+    triangles = [cycle_pairs(cycle) for cycle in find_cycles(3)]
+
+    # Длинные маршруты сохраняем отдельно
+    routes = []
+    for length in range(4, MAX_CYCLE_LENGTH + 1):
+        routes.extend((length, ",".join(cycle_pairs(cycle))) for cycle in find_cycles(length))
 
     # Записываем треугольники в базу
     cursor.executemany("INSERT INTO tab_2 (pair1, pair2, pair3) VALUES (?, ?, ?)", triangles)
+    cursor.executemany("INSERT INTO cycles (length, route) VALUES (?, ?)", routes)
     conn.commit()
     conn.close()    # ✅ Закрываем соединение
     print(f"Найдено {len(triangles)} треугольников и загружено в tab_2.")
+    if routes:
+        print(f"Найдено {len(routes)} маршрутов длиной 4–{MAX_CYCLE_LENGTH} и загружено в cycles.")
+
+
+def triangle_chains(pair1, pair2, pair3):
+    """Проверяет, что ноги замыкаются: купили base1 за quote1, продали его за quote2, продали quote2 обратно в quote1."""
+    base1, quote1 = pair1.split("-")
+    base2, quote2 = pair2.split("-")
+    base3, quote3 = pair3.split("-")
+    return base1 == base2 and quote2 == base3 and quote3 == quote1
 
+def triangle_passes_filter(pair1, pair2, pair3, targets=TARGET_CURRENCIES, targets2=TARGET_CURRENCIES2):
+    """Правила отбора треугольников (наборы валют можно подменить, например, для бэктеста)."""
+    base1, quote1 = pair1.split("-")
+    base2, quote2 = pair2.split("-")
+    base3, quote3 = pair3.split("-")
+
+    # Условие 1: каждая пара должна содержать хотя бы одну валюту конвертации
+    contains_conversion_currency = any(currency in targets for currency in [base1, quote1, base2, quote2, base3, quote3])
+
+    # Условие 2: последняя пара должна состоять только из валют конвертации
+    last_pair_valid = base3 in targets and quote3 in targets
+    
+    # Условие 3: добавляем пары конвертации BTC
+    second_valid_pair = base2 in targets2 and quote2 in targets2
+
+    # Условие 4: удаление исключенных валют
+    if any(currency in EXCLUDED_CURRENCIES for currency in [base1, quote1, base2, quote2, base3, quote3]):
+        return False
+
+    # Если треугольник соответствует условиям, сохраняем его
+    return (contains_conversion_currency and last_pair_valid) or second_valid_pair
 
 def filter_triangles():
-    #Принудительно чистим лог арбитражей
-    with open("arbitrage_log.txt", "a") as log_file:
-        log_file.truncate(0)
     logging.info("Фильтрация треугольников на соответствие правилам")
     conn = sqlite3.connect("arbitrage.db")  # ✅ Открываем соединение
     cursor = conn.cursor()
@@ -214,25 +1378,7 @@ def filter_triangles():
     valid_triangles = []
 
     for pair1, pair2, pair3 in triangles:
-        base1, quote1 = pair1.split("-")
-        base2, quote2 = pair2.split("-")
-        base3, quote3 = pair3.split("-")
-
-        # Условие 1: каждая пара должна содержать хотя бы одну валюту конвертации
-        contains_conversion_currency = any(currency in TARGET_CURRENCIES for currency in [base1, quote1, base2, quote2, base3, quote3])
-
-        # Условие 2: последняя пара должна состоять только из валют конвертации
-        last_pair_valid = base3 in TARGET_CURRENCIES and quote3 in TARGET_CURRENCIES
-        
-        # Условие 3: добавляем пары конвертации BTC
-        second_valid_pair = base2 in TARGET_CURRENCIES2 and quote2 in TARGET_CURRENCIES2
-
-        # Условие 4: удаление исключенных валют
-        if any(currency in EXCLUDED_CURRENCIES for currency in [base1, quote1, base2, quote2, base3, quote3]):
-            continue  # Пропускаем этот треугольник
-
-        # Если треугольник соответствует условиям, сохраняем его
-        if (contains_conversion_currency and last_pair_valid) or (second_valid_pair):
+        if triangle_passes_filter(pair1, pair2, pair3):
             valid_triangles.append((pair1, pair2, pair3))
 
     # Очищаем старую таблицу и записываем только валидные треугольники
@@ -251,193 +1397,1180 @@ def get_unique_pairs():
         cursor.execute("SELECT DISTINCT pair1 FROM tab_2 UNION SELECT DISTINCT pair2 FROM tab_2 UNION SELECT DISTINCT pair3 FROM tab_2")
         pairs = [row[0] for row in cursor.fetchall()]
     return pairs  # ✅ Возвращаем список пар после закрытия соединения
-pairs = get_unique_pairs()  # ✅ Теперь список пар берется безопасно
-#print(pairs)
-
-# Формирование JSON-запроса для подписки
-pairs = get_unique_pairs()
-subscribe_message = {
-    "op": "subscribe",
-    "args": [{"channel": "books", "instId": pair} for pair in pairs]
-}
-
-def split_into_chunks(lst, chunk_size):
-    """Разбивает список на части по `chunk_size`."""
-    for i in range(0, len(lst), chunk_size):
-        yield lst[i:i + chunk_size]
-
-# Подключение Websockets
-async def websocket_handler(subscribe_message):
-    retry_delay = 5  # Начальная задержка на переподключение
-    max_delay = 60   # Максимальная задержка между попытками
-
-    while True:
-        try:
-            async with websockets.connect(
-                OKX_WS_URL,
-                ssl=ssl.create_default_context(cafile=certifi.where()),
-                ping_interval=15,
-                ping_timeout=10
-            ) as ws:
-                logging.error("✅ Подключено к WebSocket обновления цен")
-                await ws.send(json.dumps(subscribe_message))
-
-                async for message in ws:
-                    await process_ws_message(message)
-
-        except websockets.exceptions.ConnectionClosed as e:
-            logging.error(f"⚠️ WebSocket обновления цен закрыт (код {e.code}): {e.reason}")
-            if e.code == 1000:
-                logging.error("✅ Нормальное завершение соединения, не переподключаемся")
-                break  # Если сервер закрыл соединение штатно, выходим
-
-        except Exception as e:
-            logging.error(f"🚨 Ошибка WebSocket обновления цен: {e}")
-            print("❌ СКРИПТ ОСТАНОВЛЕН ИЗ-ЗА ОШИБКИ ❌")  # Огромными буквами с пиктограммой
-            break  # Полностью останавливаем скрипт при критической ошибке
 
-        logging.error(f"🔄 Переподключение обновления цен через {retry_delay} сек...")
-        await asyncio.sleep(retry_delay)
+def triangles_digest(pairs):
+    """Отпечаток входных данных поиска треугольников: список пар и настройки отбора."""
+    settings = (sorted(TARGET_CURRENCIES), sorted(TARGET_CURRENCIES2), sorted(TARGET_CURRENCIES_DEF),
+                sorted(EXCLUDED_CURRENCIES), MAX_CYCLE_LENGTH)
+    return hashlib.sha1(repr((sorted(pairs), settings)).encode()).hexdigest()
 
-        # Увеличиваем задержку при частых ошибках, но не более max_delay
-        retry_delay = min(retry_delay * 2, max_delay)
+def prepare_triangles():
+    """Инструменты и треугольники при старте: поиск и фильтрация повторяются, только если изменились
+    список инструментов или настройки отбора, иначе треугольники берутся из `tab_2`."""
+    pairs = fetch_trading_pairs()
+    digest = triangles_digest(pairs)
+    with sqlite3.connect("arbitrage.db") as conn:
+        has_triangles = conn.execute("SELECT 1 FROM tab_2 LIMIT 1").fetchone() is not None
+    warm = has_triangles and cache_get("triangles_digest") == digest
+    if warm:
+        print("✅ Треугольники взяты из кэша (инструменты не менялись).")
+    else:
+        find_triangular_arbitrage()
+        filter_triangles()
+    loaded = load_triangles()
+
+    # Тёплый старт должен дать тот же граф обмена, что и холодный (иначе детектор циклов ослепнет)
+    edges = graph_edge_count()
+    if not warm:
+        with sqlite3.connect("arbitrage.db") as conn:
+            cache_set(conn, triangles_digest=digest, graph_edges=edges)
+    elif cache_get("graph_edges") not in (None, str(edges)):
+        logging.error(f"🚨 Граф валют при тёплом старте: {edges} рёбер, при холодном было {cache_get('graph_edges')}")
+    return loaded
+
+def load_triangles():
+    """Загружает треугольники из `tab_2` в память, строит граф валют по `tab_1` и размечает хранилище котировок."""
+    with sqlite3.connect("arbitrage.db") as conn:
+        cursor = conn.cursor()
+        # Граф валют нужен детектору циклов: при тёплом старте поиск треугольников его не строит
+        cursor.execute("SELECT pair FROM tab_1")
+        build_currency_graph([row[0] for row in cursor.fetchall()])
+        cursor.execute("SELECT pair1, pair2, pair3 FROM tab_2")
+        return set_triangles(cursor.fetchall())
+
+def graph_edge_count():
+    """Рёбер графа обмена по отслеживаемым инструментам — столько же строит `NegativeCycleDetector`."""
+    return 2 * len(set(pair_lookup.values()) & quote_store.index.keys())
+
+def set_triangles(new_triangles):
+    """Делает список треугольников рабочим: хранилище котировок, обратный индекс и движки расчёта."""
+    global triangles
+    triangles = list(new_triangles)
+    quote_store.register(pair for triangle in triangles for pair in triangle)
+    index_triangles()
+    return triangles
+
+def index_triangles():
+    """Обратный индекс и движки расчёта по текущим `triangles` (хранилище уже размечено)."""
+    global pair_triangles, triangle_engine, cycle_detector
+    index = {}
+    for i, triangle in enumerate(triangles):
+        for pair in set(triangle):
+            index.setdefault(pair, []).append(i)
+    pair_triangles = index
+
+    triangle_engine = TriangleEngine(quote_store, triangles) if np is not None else None
+    cycle_detector = NegativeCycleDetector(quote_store.pairs) if STRATEGY_MODE == "negative_cycles" else None
+
+def track_pairs(pairs):
+    """Инструменты, добавленные на ходу: строки в хранилище котировок, рёбра графа и треугольники с ними
+    (с недостающими ногами). Возвращает все инструменты, на которые нужно подписаться."""
+    global triangles
+    new = [pair for pair in dict.fromkeys(pairs) if pair not in quote_store.index]
+    tracked = quote_store.add(pairs)
+    new = {pair for pair in new if pair in quote_store.index}
+    if not new:
+        return tracked
+
+    add_to_currency_graph(new)
+    known = set(triangles)
+    found = [
+        triangle for triangle in dict.fromkeys(cycle_pairs(cycle) for cycle in find_cycles(3))
+        if new.intersection(triangle) and triangle not in known and triangle_passes_filter(*triangle)
+    ]
+    legs = quote_store.add(pair for triangle in found for pair in triangle)
+    found = [triangle for triangle in found if all(pair in quote_store.index for pair in triangle)]
+    if found:
+        triangles = triangles + found
+        logging.error(f"✅ Новые инструменты {', '.join(sorted(new))}: +{len(found)} треугольников")
+    index_triangles()  # Движок заново смотрит в выросшие столбцы хранилища
+    return list(dict.fromkeys(tracked + [pair for pair in legs if pair in quote_store.index]))
+
+def snapshot_quotes():
+    """Сбрасывает котировки из памяти в `tab_2` через фоновую запись (для внешнего просмотра)."""
+    rows = [
+        (pair1, pair2, pair3, *quote_store.get(pair1), *quote_store.get(pair2), *quote_store.get(pair3))
+        for pair1, pair2, pair3 in triangles
+    ]
+    persistence.write("DELETE FROM tab_2")
+    persistence.write_many("INSERT INTO tab_2 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+# Разбор JSON: быстрые библиотеки при наличии, иначе стандартный json
+def json_backends():
+    """Доступные реализации: имя -> функция разбора строки/байтов в dict."""
+    backends = {"json": json.loads}
+    if orjson is not None:
+        backends["orjson"] = orjson.loads
+    if msgspec is not None:
+        backends["msgspec"] = msgspec.json.Decoder().decode
+    return backends
+
+def select_json_backend(name=JSON_BACKEND):
+    """Возвращает (имя, функция разбора); недоступная библиотека заменяется стандартным json."""
+    backends = json_backends()
+    if name == "auto":
+        name = next(backend for backend in ("msgspec", "orjson", "json") if backend in backends)
+    elif name not in backends:
+        logging.error(f"⚠️ JSON-библиотека {name} не установлена, используем json")
+        name = "json"
+    return name, backends[name]
+
+
+if msgspec is not None:
+    # Типизированная схема кадра канала `books`: лишние поля пропускаются без создания объектов
+    class BookArg(msgspec.Struct):
+        channel: str = ""
+        instId: str = ""
+
+    class BookData(msgspec.Struct):
+        bids: msgspec.Raw = msgspec.Raw(b"[]")
+        asks: msgspec.Raw = msgspec.Raw(b"[]")
+        checksum: int | None = None
+        seqId: int | None = None
+        prevSeqId: int | None = None
+
+    class BookFrame(msgspec.Struct):
+        event: str = ""
+        arg: BookArg | None = None
+        action: str = "snapshot"
+        data: list[BookData] | None = None
+
+    book_frame_decoder = msgspec.json.Decoder(BookFrame)
+    book_levels_decoder = msgspec.json.Decoder(list[list[str]])
+
+
+class LazyLevels:
+    """Уровни стакана как сырой JSON: список строится при первом обращении, то есть только
+    если сообщение действительно применяют к стакану (не при рассинхронизации и не для чужих инструментов)."""
+
+    __slots__ = ("raw", "levels")
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.levels = None
+
+    def materialize(self):
+        if self.levels is None:
+            self.levels = book_levels_decoder.decode(self.raw)
+        return self.levels
+
+    def __iter__(self):
+        return iter(self.materialize())
+
+    def __reversed__(self):
+        return reversed(self.materialize())
+
+    def __len__(self):
+        return len(self.materialize())
+
+    def __getitem__(self, i):
+        return self.materialize()[i]
+
+
+def make_frame_decoder(name=JSON_BACKEND, lazy=LAZY_BOOK_DECODE, lazy_min_size=2048):
+    """Функция разбора кадра публичного канала в dict той же формы, что даёт `json.loads`.
+    Ленивый разбор включается только для крупных кадров (снимки): мелкие обновления быстрее разобрать сразу."""
+    name, loads = select_json_backend(name)
+    if name != "msgspec" or not lazy:
+        return loads
+
+    def decode(message):
+        if len(message) < lazy_min_size:
+            return loads(message)
+        try:
+            frame = book_frame_decoder.decode(message)
+        except msgspec.ValidationError:
+            return loads(message)  # Кадр не по схеме `books` — разбираем целиком
+        result = {"action": frame.action}
+        if frame.event:
+            result["event"] = frame.event
+        if frame.arg is not None:
+            result["arg"] = {"channel": frame.arg.channel, "instId": frame.arg.instId}
+        if frame.data is not None:
+            result["data"] = data = []
+            for item in frame.data:
+                levels = {"bids": LazyLevels(item.bids), "asks": LazyLevels(item.asks)}
+                if item.checksum is not None:
+                    levels["checksum"] = item.checksum
+                if item.seqId is not None:
+                    levels["seqId"] = item.seqId
+                if item.prevSeqId is not None:
+                    levels["prevSeqId"] = item.prevSeqId
+                data.append(levels)
+        return result
+
+    return decode
+
+decode_json = select_json_backend()[1]  # Приватный канал, ответы биржи, записи потока
+decode_frame = make_frame_decoder()  # Публичный канал стаканов
+
+def run_loop(coro):
+    """`asyncio.run` на uvloop, если он установлен и включён."""
+    if USE_UVLOOP and uvloop is not None:
+        with asyncio.Runner(loop_factory=uvloop.new_event_loop) as runner:
+            return runner.run(coro)
+    return asyncio.run(coro)
+
+# Подключения публичного WebSocket: инструменты распределяются по соединениям с учётом нагрузки
+class WsConnection:
+    """Одно публичное соединение и закреплённые за ним инструменты."""
+
+    def __init__(self, number):
+        self.number = number
+        self.pairs = set()
+        self.ws = None  # None, пока соединение не открыто
+        self.counts = {}  # instId -> сообщений с прошлого пересчёта
+        self.rates = {}  # instId -> сглаженный поток сообщений в секунду
+        self.task = None
+
+    def load(self):
+        return sum(self.rates.values())
+
+
+class SubscriptionManager:
+    """Раскладывает инструменты по соединениям в пределах `WS_ARGS_PER_CONNECTION` и `WS_MSG_RATE_BUDGET`,
+    переносит самые активные инструменты с перегруженных соединений и переподписывает только упавшее.
+    `add` и `remove` можно вызывать из любого потока — без переподключения остальных инструментов."""
+
+    def __init__(self, url=OKX_WS_URL):
+        self.url = url
+        self.connections = []
+        self.loop = None
+        self.connect_lock = None
+        self.last_connect = 0.0
+        self.running = False  # Менеджер работает: только тогда `revive` поднимает упавшие соединения
+
+    async def run(self, pairs):
+        self.loop = asyncio.get_running_loop()
+        self.connect_lock = asyncio.Lock()
+        self.connections = []
+        self._add(pairs)
+        logging.error(f"✅ {len(pairs)} инструментов распределено по {len(self.connections)} соединениям")
+        measured_at = time.monotonic()
+        self.running = True
+        try:
+            while True:
+                await asyncio.sleep(WS_REBALANCE_INTERVAL)
+                now = time.monotonic()
+                self.measure(now - measured_at)
+                measured_at = now
+                self.rebalance()
+        finally:
+            # Соединения — отдельные задачи: при остановке или перезапуске закрываем их вместе с менеджером
+            self.running = False
+            for connection in self.connections:
+                connection.task.cancel()
+
+    def add(self, pairs):
+        """Подписывается на новые инструменты (из любого потока)."""
+        self.loop.call_soon_threadsafe(self._add, list(pairs))
+
+    def remove(self, pairs):
+        """Отписывается от инструментов (из любого потока)."""
+        self.loop.call_soon_threadsafe(self._remove, list(pairs))
+
+    def _add(self, pairs):
+        # Сначала строки в хранилище котировок: иначе первое же сообщение по новому инструменту некуда записать
+        pairs = track_pairs(pairs)
+        assigned = {pair for connection in self.connections for pair in connection.pairs}
+        added = {}
+        for pair in pairs:
+            if pair in assigned:
+                continue
+            connection = self.pick_connection()
+            connection.pairs.add(pair)
+            assigned.add(pair)
+            added.setdefault(connection, []).append(pair)
+        for connection, new_pairs in added.items():
+            self.send(connection, "subscribe", new_pairs)
+
+    def _remove(self, pairs):
+        for connection in self.connections:
+            removed = [pair for pair in pairs if pair in connection.pairs]
+            if not removed:
+                continue
+            connection.pairs.difference_update(removed)
+            for pair in removed:
+                connection.rates.pop(pair, None)
+                order_books.pop(pair, None)
+                quote_store.invalidate(pair)
+            self.send(connection, "unsubscribe", removed)
+
+    def revive(self):
+        """Перезапускает соединения, задача которых завершилась; возвращает их номера."""
+        revived = []
+        if not self.running:
+            return revived
+        for connection in self.connections:
+            if connection.task is not None and connection.task.done():
+                connection.task = self.loop.create_task(self.run_connection(connection))
+                revived.append(connection.number)
+        return revived
+
+    def pick_connection(self):
+        """Наименее загруженное соединение со свободным местом, иначе новое (если не упёрлись в предел)."""
+        free = [c for c in self.connections if len(c.pairs) < WS_ARGS_PER_CONNECTION]
+        if free:
+            return min(free, key=lambda c: (c.load(), len(c.pairs)))
+        if len(self.connections) < WS_MAX_CONNECTIONS:
+            return self.open_connection()
+        return min(self.connections, key=lambda c: len(c.pairs))
+
+    def open_connection(self):
+        connection = WsConnection(len(self.connections))
+        self.connections.append(connection)
+        connection.task = self.loop.create_task(self.run_connection(connection))
+        return connection
+
+    def send(self, connection, op, pairs):
+        """Отправляет subscribe/unsubscribe пачками; закрытое соединение подпишется само при подключении."""
+        if connection.ws is not None and pairs:
+            self.loop.create_task(self.send_batches(connection.ws, op, pairs))
+
+    @staticmethod
+    async def send_batches(ws, op, pairs):
+        for i in range(0, len(pairs), WS_SUBSCRIBE_BATCH):
+            args = [{"channel": book_channel(pair), "instId": pair} for pair in pairs[i:i + WS_SUBSCRIBE_BATCH]]
+            await ws.send(json.dumps({"op": op, "args": args}))
+
+    def measure(self, elapsed):
+        """Обновляет сглаженный поток сообщений по каждому инструменту."""
+        for connection in self.connections:
+            counts, connection.counts = connection.counts, {}
+            for pair in connection.pairs:
+                rate = counts.get(pair, 0) / elapsed
+                connection.rates[pair] = 0.5 * connection.rates.get(pair, rate) + 0.5 * rate
+
+    def rebalance(self):
+        """Переносит самые активные инструменты с самого загруженного соединения на самое свободное."""
+        if not self.connections:
+            return
+        hot = max(self.connections, key=WsConnection.load)
+        cold = min(self.connections, key=WsConnection.load)
+        if hot.load() <= WS_MSG_RATE_BUDGET and hot.load() <= 2 * cold.load() + 1:
+            return  # Нагрузка в пределах бюджета и распределена ровно
+        if hot.load() > WS_MSG_RATE_BUDGET and (cold is hot or cold.load() > WS_MSG_RATE_BUDGET / 2) \
+                and len(self.connections) < WS_MAX_CONNECTIONS:
+            cold = self.open_connection()
+
+        moved = []
+        for pair in sorted(hot.pairs, key=lambda p: hot.rates.get(p, 0), reverse=True):
+            rate = hot.rates.get(pair, 0)
+            if len(moved) >= WS_REBALANCE_MOVES or len(cold.pairs) >= WS_ARGS_PER_CONNECTION:
+                break
+            if cold.load() + rate >= hot.load() - rate:
+                continue  # Перенос не выравнивает нагрузку
+            hot.pairs.discard(pair)
+            cold.pairs.add(pair)
+            cold.rates[pair] = hot.rates.pop(pair, 0)
+            moved.append(pair)
+        if moved:
+            logging.error(f"🔀 Перенос {len(moved)} инструментов с соединения {hot.number} на {cold.number}: {', '.join(moved)}")
+            self.send(hot, "unsubscribe", moved)
+            self.send(cold, "subscribe", moved)
+
+    async def throttle_connect(self):
+        async with self.connect_lock:
+            delay = self.last_connect + WS_CONNECT_INTERVAL - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self.last_connect = time.monotonic()
+
+    async def run_connection(self, connection):
+        retry_delay = 5  # Начальная задержка на переподключение
+        max_delay = 60   # Максимальная задержка между попытками
+
+        while True:
+            try:
+                await self.throttle_connect()
+                async with websockets.connect(
+                    self.url,
+                    ssl=ws_ssl_context(self.url),
+                    ping_interval=15,
+                    ping_timeout=10
+                ) as ws:
+                    logging.error(f"✅ Подключено к WebSocket обновления цен (соединение {connection.number}, "
+                                  f"{len(connection.pairs)} инструментов)")
+                    connection.ws = ws
+                    retry_delay = 5
+                    await self.send_batches(ws, "subscribe", sorted(connection.pairs))
+
+                    async for message in ws:
+                        received_ns = time.perf_counter_ns()
+                        if feed_recorder is not None:
+                            feed_recorder.write(SOURCE_PUBLIC, message)
+                        await process_ws_message(message, ws, received_ns, connection)
+
+            except websockets.exceptions.ConnectionClosed as e:
+                logging.error(f"⚠️ WebSocket обновления цен {connection.number} закрыт (код {e.code}): {e.reason}")
+                if e.code == 1000:
+                    logging.error("✅ Нормальное завершение соединения, не переподключаемся")
+                    break  # Если сервер закрыл соединение штатно, выходим
+
+            except Exception as e:
+                # Сбой подключения или рукопожатия — переподключаемся с нарастающей паузой, а не бросаем инструменты
+                logging.error(f"🚨 Ошибка WebSocket обновления цен {connection.number}: {e}")
+
+            finally:
+                connection.ws = None
+                # Котировки этого соединения устарели, до нового снимка не торгуем по ним
+                for pair in connection.pairs:
+                    quote_store.invalidate(pair)
+
+            logging.error(f"🔄 Переподключение обновления цен {connection.number} через {retry_delay} сек...")
+            await asyncio.sleep(retry_delay)
+
+            # Увеличиваем задержку при частых ошибках, но не более max_delay
+            retry_delay = min(retry_delay * 2, max_delay)
+
+def book_channel(pair):
+    """Канал котировок инструмента: `BOOK_CHANNELS` или `BOOK_CHANNEL` по умолчанию."""
+    return BOOK_CHANNELS.get(pair, BOOK_CHANNEL)
+
+async def resubscribe_book(ws, pair):
+    """Переподписка на стакан одного инструмента: после неё OKX пришлёт свежий снимок."""
+    args = [{"channel": book_channel(pair), "instId": pair}]
+    await ws.send(json.dumps({"op": "unsubscribe", "args": args}))
+    await ws.send(json.dumps({"op": "subscribe", "args": args}))
+
+def quote_written(index):
+    """Результат записи в хранилище: True, либо None, если инструмент не отслеживается (-1) — это не рассинхронизация."""
+    return True if index >= 0 else None
+
+def apply_book_message(data, received_ns=0):
+    """Применяет сообщение канала `books` к стакану и хранилищу котировок.
+    Возвращает True, если обновился верх стакана, False при рассинхронизации (разрыв seqId или checksum),
+    None — если обновлять нечего или инструмент не отслеживается."""
+    pair = data["arg"]["instId"]
+    book = order_books.get(pair)
+    if book is None:
+        book = order_books[pair] = OrderBook(pair)
+
+    action = data.get("action", "snapshot")
+    was_synced = book.seq_id is not None
+    if not book.apply(action, data["data"][0]):
+        quote_store.invalidate(pair)
+        if was_synced or action == "snapshot":
+            # Битый снимок тоже переподписываем: иначе первый же сбой checksum оставит инструмент без котировок
+            logging.error(f"⚠️ Стакан {pair} рассинхронизирован (разрыв seqId или checksum), переподписка")
+            return False
+        return None  # Хвост обновлений, пока уже ждём снимок после переподписки
+
+    if not book.bid_keys or not book.ask_keys:
+        return None
+    return quote_written(quote_store.update_book(pair, book, received_ns))
+
+def apply_depth_message(data, received_ns=0):
+    """Канал `books5`: каждое сообщение — полный снимок 5 уровней, без seqId-цепочки и контрольной суммы."""
+    pair = data["arg"]["instId"]
+    book = order_books.get(pair)
+    if book is None:
+        book = order_books[pair] = OrderBook(pair)
+    book.apply("snapshot", data["data"][0])
+    if not book.bid_keys or not book.ask_keys:
+        return None
+    return quote_written(quote_store.update_book(pair, book, received_ns))
 
-async def process_ws_message(message):
+def apply_bbo_message(data, received_ns=0):
+    """Канал `bbo-tbt`: только лучшие bid/ask, стакан не ведём."""
+    levels = data["data"][0]
+    bids, asks = levels.get("bids"), levels.get("asks")
+    if not bids or not asks:
+        return None
+    bid_price, bid_volume, *_ = bids[0]
+    ask_price, ask_volume, *_ = asks[0]
+    return quote_written(quote_store.update(
+        data["arg"]["instId"], float(bid_price), float(ask_price), float(bid_volume), float(ask_volume), received_ns
+    ))
+
+# Разбор сообщения по каналу: все пишут в одно хранилище котировок
+BOOK_PARSERS = {"books": apply_book_message, "books5": apply_depth_message, "bbo-tbt": apply_bbo_message}
+
+async def process_ws_message(message, ws=None, received_ns=None, connection=None):
+    global last_tick_ns
+    pair = None
     try:
-        data = json.loads(message)
+        received_ns = received_ns or time.perf_counter_ns()
+        data = decode_frame(message)
+        parsed_ns = record_latency("parse", received_ns)
         if "arg" in data and "data" in data:
             pair = data["arg"]["instId"]
-            bids = data["data"][0].get("bids", [])
-            asks = data["data"][0].get("asks", [])
-
-            bid_price = float(bids[0][0]) if bids else None
-            bid_volume = float(bids[0][1]) if bids else None
-            ask_price = float(asks[0][0]) if asks else None
-            ask_volume = float(asks[0][1]) if asks else None
-
-            if bid_price is not None and ask_price is not None:
-                conn = sqlite3.connect("arbitrage.db")
-                cursor = conn.cursor()
-                cursor.execute(
-                    """
-                    UPDATE tab_2 
-                    SET 
-                        bid1 = CASE WHEN pair1 = ? THEN ? ELSE bid1 END,
-                        ask1 = CASE WHEN pair1 = ? THEN ? ELSE ask1 END,
-                        bid1_volume = CASE WHEN pair1 = ? THEN ? ELSE bid1_volume END,
-                        ask1_volume = CASE WHEN pair1 = ? THEN ? ELSE ask1_volume END,
-
-                        bid2 = CASE WHEN pair2 = ? THEN ? ELSE bid2 END,
-                        ask2 = CASE WHEN pair2 = ? THEN ? ELSE ask2 END,
-                        bid2_volume = CASE WHEN pair2 = ? THEN ? ELSE bid2_volume END,
-                        ask2_volume = CASE WHEN pair2 = ? THEN ? ELSE ask2_volume END,
-
-                        bid3 = CASE WHEN pair3 = ? THEN ? ELSE bid3 END,
-                        ask3 = CASE WHEN pair3 = ? THEN ? ELSE ask3 END,
-                        bid3_volume = CASE WHEN pair3 = ? THEN ? ELSE bid3_volume END,
-                        ask3_volume = CASE WHEN pair3 = ? THEN ? ELSE ask3_volume END
-                    WHERE pair1 = ? OR pair2 = ? OR pair3 = ?
-                    """,
-                    (
-                        pair, bid_price, pair, ask_price, pair, bid_volume, pair, ask_volume, 
-                        pair, bid_price, pair, ask_price, pair, bid_volume, pair, ask_volume, 
-                        pair, bid_price, pair, ask_price, pair, bid_volume, pair, ask_volume,
-                        pair, pair, pair
-                    )
-                )
-                updated_rows = cursor.rowcount
-                conn.commit()
-                conn.close()
+            if connection is not None:
+                if pair not in connection.pairs:
+                    return  # Хвост старой подписки: инструмент перенесён на другое соединение
+                connection.counts[pair] = connection.counts.get(pair, 0) + 1
+            updated = BOOK_PARSERS.get(data["arg"].get("channel"), apply_book_message)(data, received_ns)
+            book_ns = record_latency("book_update", parsed_ns)
+            if updated and evaluate_on_tick:
+                last_tick_ns = received_ns
+                on_quote_update(pair)
+                record_latency("evaluate", book_ns)
+            elif updated is False and ws is not None and pair in quote_store.index:
+                await resubscribe_book(ws, pair)
+
+    except websockets.ConnectionClosed:
+        raise  # Разрыв обрабатывает run_connection
+    except Exception as e:
+        # Одно битое сообщение не останавливает бота: пропускаем его, а стакан инструмента берём заново
+        logging.error(f"🚨 Ошибка обработки WebSocket-сообщения{f' {pair}' if pair else ''}: {e}")
+        if pair in quote_store.index:
+            order_books.pop(pair, None)
+            quote_store.invalidate(pair)
+            if ws is not None:
+                await resubscribe_book(ws, pair)
+
+subscriptions = None  # SubscriptionManager цикла приёма стаканов этого процесса
+
+# Единый рантайм: все компоненты бота — задачи одного цикла событий
+PRIORITY_CRITICAL, PRIORITY_NORMAL, PRIORITY_BACKGROUND = 0, 1, 2
+
+class Runtime:
+    """Задачи с приоритетами под надзором: упавшие перезапускаются с паузой, фоновые пропускают запуск,
+    пока цикл событий перегружен, при остановке задачи снимаются от фоновых к критичным."""
+
+    def __init__(self):
+        self.specs = {}  # имя -> (фабрика корутины, приоритет)
+        self.tasks = {}  # имя -> asyncio.Task
+        self.restarts = {}  # имя -> число перезапусков
+        self.loop_lag = 0.0  # Последняя измеренная задержка цикла событий (в секундах)
+        self.healthy = True
+        self.stopping = None
+        self.executor = None
+
+    def add(self, name, factory, priority=PRIORITY_NORMAL):
+        self.specs[name] = (factory, priority)
+
+    def periodic(self, name, function, interval, priority=PRIORITY_BACKGROUND, in_executor=False):
+        """Вызывает `function` раз в `interval` секунд (в потоке-исполнителе, если он включён)."""
+        async def run():
+            while True:
+                await asyncio.sleep(interval)
+                if priority == PRIORITY_BACKGROUND and self.loop_lag > RUNTIME_LAG_BUDGET:
+                    continue  # Уступаем цикл приёму стаканов и исполнению
+                try:
+                    if in_executor and self.executor is not None:
+                        await asyncio.get_running_loop().run_in_executor(self.executor, function)
+                    else:
+                        function()
+                except Exception as e:
+                    logging.error(f"⚠️ Ошибка задачи {name}: {e}")
+        self.add(name, run, priority)
+
+    async def supervise(self, name):
+        factory, _ = self.specs[name]
+        delay = 1
+        while True:
+            started = time.monotonic()
+            try:
+                await factory()
+                logging.error(f"⚠️ Задача {name} завершилась, перезапускаем")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"🚨 Задача {name} упала: {e}")
+                traceback.print_exc()
+            self.restarts[name] = self.restarts.get(name, 0) + 1
+            if time.monotonic() - started > 60:
+                delay = 1  # Долго проработала — считаем сбой разовым
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30)
+
+    async def health(self):
+        """Замеряет задержку цикла событий и раз в `RUNTIME_HEALTH_INTERVAL` проверяет компоненты."""
+        probe = 0.1
+        next_check = time.monotonic() + RUNTIME_HEALTH_INTERVAL
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(probe)
+            now = time.monotonic()
+            self.loop_lag = max(0.0, now - started - probe)
+            if now >= next_check:
+                next_check = now + RUNTIME_HEALTH_INTERVAL
+                self.check()
+
+    def check(self):
+        problems = []
+        if self.loop_lag > RUNTIME_LAG_BUDGET:
+            problems.append(f"задержка цикла событий {self.loop_lag * 1000:.1f} мс")
+        if not trade_session.ready.is_set():
+            problems.append("приватная сессия не подключена")
+        age = feed_age()
+        if age is None or age > RUNTIME_STALE_FEED:
+            problems.append("котировок ещё не было" if age is None else f"нет котировок {age:.0f} сек")
+        problems += [f"задача {name} остановлена" for name, task in self.tasks.items() if task.done()]
+        if subscriptions is not None and subscriptions.running:
+            problems += [f"соединение котировок {number} остановлено, перезапускаем" for number in subscriptions.revive()]
+            problems += [f"соединение котировок {connection.number} не подключено"
+                         for connection in subscriptions.connections if connection.ws is None]
+        self.healthy = not problems
+        for problem in problems:
+            logging.error(f"🩺 {problem}")
+
+    def stop(self):
+        if self.stopping is not None:
+            self.stopping.set()
+
+    async def run(self):
+        """Запускает задачи по приоритету и ждёт SIGINT/SIGTERM, после чего останавливает всё по порядку."""
+        loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self.stop)
+            except (NotImplementedError, RuntimeError):
+                pass  # Windows или не главный поток: остаётся KeyboardInterrupt
+        if EVALUATION_EXECUTOR:
+            self.executor = ThreadPoolExecutor(1, thread_name_prefix="evaluate")
+        self.add("health", self.health, PRIORITY_NORMAL)
+        for name in sorted(self.specs, key=lambda name: self.specs[name][1]):
+            self.tasks[name] = asyncio.create_task(self.supervise(name), name=name)
+        try:
+            await self.stopping.wait()
+        finally:
+            await self.shutdown()
+
+    async def shutdown(self):
+        logging.error("🛑 Остановка: новые сделки не начинаем, ждём текущие")
+        await self.cancel(PRIORITY_BACKGROUND)
+        if watcher_thread is not None:
+            # Поток оценки публикует в цикл событий — останавливаем его, пока цикл ещё открыт
+            watcher_stop.set()
+            await asyncio.to_thread(watcher_thread.join, RUNTIME_SHUTDOWN_TIMEOUT)
+        opportunities.close()
+        deadline = time.monotonic() + RUNTIME_SHUTDOWN_TIMEOUT
+        while opportunities.in_flight and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        await self.cancel(PRIORITY_NORMAL)
+        await self.cancel(PRIORITY_CRITICAL)
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+        logging.error("✅ Все задачи остановлены")
+
+    async def cancel(self, priority):
+        tasks = [task for name, task in self.tasks.items() if self.specs[name][1] == priority]
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.wait(tasks, timeout=RUNTIME_SHUTDOWN_TIMEOUT)
+
+    def stats(self):
+        return {
+            "loop_lag_seconds": self.loop_lag, "healthy": int(self.healthy),
+            "private_session_ready": int(trade_session.ready.is_set()), "feed_age_seconds": feed_age() or 0,
+        }
 
 
-    except Exception as e:
-        logging.error(f"Ошибка обработки WebSocket-сообщения: {e}")
-        print("\n" + "="*50)
-        print("🚨 СКРИПТ ОСТАНОВЛЕН ИЗ-ЗА ОШИБКИ 🚨".center(50))
-        print("="*50 + "\n")
-        sys.exit(1)  # Завершаем выполнение скрипта с кодом ошибки 1
+runtime = Runtime()
+
+def feed_age():
+    """Сколько секунд назад пришла последняя котировка (None — ещё ни одной)."""
+    latest = max((t for t in quote_store.updated_at if not math.isnan(t)), default=None)
+    return None if latest is None else time.monotonic() - latest
 
 async def main():
-    pairs = get_unique_pairs()
-    chunk_size = max(1, len(pairs) // 3)  # ✅ Разбиваем список на 3 части
-    tasks = []
-    
-    for chunk in split_into_chunks(pairs, chunk_size):
-        subscribe_message = {
-            "op": "subscribe",
-            "args": [{"channel": "books", "instId": pair} for pair in chunk]
-        }
-        tasks.append(asyncio.create_task(websocket_handler(subscribe_message)))
-    
-    await asyncio.gather(*tasks)  # ✅ Запускаем все WebSocket-потоки
+    """Весь бот в одном цикле событий: одна приватная сессия (ордера, баланс, исполнения), приём стаканов,
+    исполнитель, периодический пересчёт и служебные задачи."""
+    global subscriptions, inventory_lock
+    opportunities.bind(asyncio.get_running_loop())
+    runtime.add("private_session", trade_session.run, PRIORITY_CRITICAL)
+    if INGEST_WORKERS == 0:  # Иначе стаканы принимают процессы-шарды
+        subscriptions = SubscriptionManager()
+        pairs = get_unique_pairs()
+        runtime.add("market_data", lambda: subscriptions.run(pairs), PRIORITY_CRITICAL)
+    runtime.add("executor", triangular_arbitrage, PRIORITY_CRITICAL)
+    if EXECUTION_MODE == "parallel":
+        inventory_lock = asyncio.Lock()
+        runtime.add("rebalancer", inventory_rebalancer, PRIORITY_NORMAL)
+    runtime.periodic("analyze", analyze_triangles, UPDATE_INTERVAL, PRIORITY_NORMAL, in_executor=True)
+    if METRICS_PORT:
+        runtime.add("metrics", serve_metrics, PRIORITY_NORMAL)
+    if LATENCY_METRICS:
+        runtime.periodic("metrics_dump", dump_metrics, METRICS_DUMP_INTERVAL)
+    if QUOTE_SNAPSHOT_INTERVAL > 0:
+        runtime.periodic("quote_snapshot", snapshot_quotes, QUOTE_SNAPSHOT_INTERVAL)
+    await runtime.run()
+
+# Горизонтальное масштабирование приёма: каждый шард — отдельный процесс со своим WebSocket
+def ingest_context():
+    # spawn, а не fork: шарды перезапускаются из процесса с потоками SQLite, логов и оценки, а fork копирует
+    # их блокировки в том состоянии, в каком застал, — дочерний процесс может навсегда повиснуть на чужой
+    return multiprocessing.get_context("spawn")
+
+def ingest_worker(name, all_pairs, shard_number, shard):
+    """Процесс-шард: свои стаканы и разбор JSON, наружу — только котировки в общей памяти."""
+    global quote_store, evaluate_on_tick, feed_recorder, subscriptions
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C ловит главный процесс и останавливает шарды сам
+    quote_store = SharedQuoteStore(name)
+    quote_store.register(all_pairs)
+    evaluate_on_tick = False
+    feed_recorder = MarketRecorder(f"{RECORD_PATH}.shard{shard_number}") if RECORD_PATH else None
+    subscriptions = SubscriptionManager()
+    run_loop(subscriptions.run(shard))
+
+def start_ingest_worker(shard_number, shard):
+    process = ingest_context().Process(
+        target=ingest_worker, args=(quote_store.name, quote_store.pairs, shard_number, shard),
+        name=f"ingest-{shard_number}", daemon=True,
+    )
+    process.start()
+    return process
+
+def start_ingest_workers(count=INGEST_WORKERS):
+    """Делит инструменты на `count` шардов по кругу и запускает процесс на каждый."""
+    ingest_workers[:] = [
+        [start_ingest_worker(k, quote_store.pairs[k::count]), k, quote_store.pairs[k::count]]
+        for k in range(count)
+    ]
+    logging.error(f"✅ Запущено {count} процессов приёма стаканов, {len(quote_store.pairs)} инструментов")
+
+def check_ingest_workers():
+    """Перезапускает упавшие шарды; их котировки до нового снимка считаются отсутствующими."""
+    for worker in ingest_workers:
+        process, shard_number, shard = worker
+        if not process.is_alive():
+            logging.error(f"⚠️ Шард приёма {shard_number} завершился (код {process.exitcode}), перезапуск")
+            for pair in shard:
+                quote_store.invalidate(pair)
+            worker[0] = start_ingest_worker(shard_number, shard)
+
+def shared_quote_watcher():
+    """Процесс-оценщик: находит изменённые строки по счётчикам seqlock и пересчитывает затронутые треугольники."""
+    global last_tick_ns
+    store = quote_store
+    seen = array("q", bytes(8 * len(store.pairs)))
+    if np is not None:
+        seq_view, seen_view = np.frombuffer(store.seq, dtype=np.int64), np.frombuffer(seen, dtype=np.int64)
+    next_check = time.monotonic() + 1
+    while not watcher_stop.is_set():
+        if np is not None:
+            changed = np.flatnonzero(seq_view != seen_view).tolist()
+        else:
+            changed = [i for i in range(len(seen)) if store.seq[i] != seen[i]]
+        for i in changed:
+            seq = store.seq[i]
+            if seq & 1:
+                continue  # Шард сейчас пишет строку — подхватим на следующем проходе
+            seen[i] = seq
+            last_tick_ns = store.received_ns[i]
+            start_ns = record_latency("shm_handoff", last_tick_ns)
+            on_quote_update(store.pairs[i])
+            record_latency("evaluate", start_ns)
+        if not changed:
+            time.sleep(SHARED_POLL_INTERVAL)
+        if time.monotonic() >= next_check:
+            check_ingest_workers()
+            next_check = time.monotonic() + 1
+
+# Считает один треугольник по текущим котировкам из памяти
+def evaluate_triangle(pair1, pair2, pair3, store=None):
+    """Возвращает строку формата `tab_3` или None, если нет данных или не хватает объёма."""
+    store = store or quote_store
+    # Горячий путь каждого тика: читаем столбцы напрямую, без кортежа на инструмент
+    index = store.index
+    i, j, k = index.get(pair1, -1), index.get(pair2, -1), index.get(pair3, -1)
+    if i < 0 or j < 0 or k < 0:
+        return None
+    bid1, ask1, ask1_volume = store.bid[i], store.ask[i], store.ask_volume[i]
+    bid2, ask2, bid2_volume = store.bid[j], store.ask[j], store.bid_volume[j]
+    bid3, ask3 = store.bid[k], store.ask[k]
+    if math.isnan(bid1 + ask1 + ask1_volume + bid2 + ask2 + bid2_volume + bid3 + ask3):  # NaN — нет данных
+        logging.warning("Пропущен треугольник %s → %s → %s (нет данных bid/ask/volume)", pair1, pair2, pair3)
+        return None
+
+    required_ask1_volume = 200 / ask1
+    required_bid2_volume = 200 / bid2
+
+    if ask1_volume == 0 or bid2_volume == 0:
+        return None
+
+    if ask1_volume < required_ask1_volume or bid2_volume < required_bid2_volume:
+        return None
+
+    step1 = INITIAL_BALANCE / ask1
+    step2 = step1 * bid2
+    final_balance = step2 * bid3
+    return (pair1, bid1, ask1, pair2, bid2, ask2, pair3, bid3, ask3, final_balance)
+
+# Расчёт объёма сделки по глубине стаканов всех трёх ног
+TriangleSize = namedtuple("TriangleSize", "notional final_balance profit vwap1 vwap2 vwap3")
+
+def size_triangle(pair1, pair2, pair3, max_notional=None, depth=SIZING_DEPTH):
+    """Находит объём первой сделки (в валюте котировки pair1), при котором прибыль после комиссий и
+    проскальзывания максимальна: покупка pair1 по ask, продажа pair2 и pair3 по bid."""
+    # Свой стакан есть только при приёме в этом процессе, иначе — уровни из общей памяти шардов
+    books = [order_books.get(pair) or quote_store.book(pair) for pair in (pair1, pair2, pair3)]
+    if None in books:
+        return None
+
+    # Уровни каждой ноги как (курс, ёмкость во входной валюте ноги)
+    legs = [
+        [(1 / price, price * size) for price, size in books[0].asks(depth)],
+        [(price, size) for price, size in books[1].bids(depth)],
+        [(price, size) for price, size in books[2].bids(depth)],
+    ]
+    if not all(legs):
+        return None
+
+    keep = 1 - TRADE_FEE
+    level = [0, 0, 0]
+    remaining = [legs[k][0][1] for k in range(3)]
+    spent = [0.0, 0.0, 0.0]
+    received = [0.0, 0.0, 0.0]
+    notional = 0.0
 
-# Функция для анализа арбитража в потоке
-def analyze_triangles_thread():
     while True:
-        analyze_triangles()
-        time.sleep(UPDATE_INTERVAL)
+        rates = [legs[k][level[k]][0] for k in range(3)]
+        if rates[0] * rates[1] * rates[2] * keep ** 3 <= 1:
+            break  # Следующая единица объёма уже убыточна: дальше прибыль только падает
+
+        # Сколько входной валюты попадает в каждую ногу на единицу объёма первой сделки
+        scale = [1.0, rates[0] * keep, rates[0] * rates[1] * keep * keep]
+        step = min(remaining[k] / scale[k] for k in range(3))
+        if max_notional is not None:
+            step = min(step, max_notional - notional)
+        for k in range(3):
+            amount = step * scale[k]
+            spent[k] += amount
+            received[k] += amount * rates[k]
+            remaining[k] -= amount
+        notional += step
+
+        if max_notional is not None and notional >= max_notional:
+            break
+        exhausted = False
+        for k in range(3):
+            if remaining[k] <= legs[k][level[k]][1] * 1e-12:
+                level[k] += 1
+                if level[k] == len(legs[k]):
+                    exhausted = True  # Стакан закончился в пределах учитываемой глубины
+                    break
+                remaining[k] = legs[k][level[k]][1]
+        if exhausted:
+            break
+
+    if notional <= 0:
+        return None
+    final_balance = received[2] * keep
+    return TriangleSize(
+        notional, final_balance, final_balance - notional,
+        spent[0] / received[0], received[1] / spent[1], received[2] / spent[2],
+    )
+
+# Пересчёт по событию: только треугольники, в которых участвует обновлённый инструмент
+def on_quote_update(pair):
+    if cycle_detector is not None:
+        cycle_detector.on_quote(pair)
+        return
+    for i in pair_triangles.get(pair, ()):
+        row = evaluate_triangle(*triangles[i])
+        if row is not None and row[-1] > PROFIT_PERCENT:
+            publish_opportunity(i, row)
+        else:
+            opportunities.discard(i)
+
+def publish_opportunity(key, row):
+    """Передаёт найденный треугольник в цикл исполнения (вызывается из потока WebSocket)."""
+    if opportunities.publish(key, row, last_tick_ns):
+        persistence.write(INSERT_OPPORTUNITY, (time.time(), row[0], row[3], row[6], row[-1]))
 
 # Находит пары для треугольного арбитража, сравнивая цены и обьемы
 def analyze_triangles():
     logging.info("Начат анализ треугольников")
-    conn = sqlite3.connect("arbitrage.db")
-    cursor = conn.cursor()
-    
-    cursor.execute("SELECT pair1, bid1, ask1, ask1_volume, pair2, bid2, ask2, bid2_volume, pair3, bid3, ask3 FROM tab_2")
-    triangles = cursor.fetchall()
-    
     results = []
-    log_entries = []
-    successful_arbitrages = []
     
-    for pair1, bid1, ask1, ask1_volume, pair2, bid2, ask2, bid2_volume, pair3, bid3, ask3 in triangles:
-        if None in (bid1, ask1, ask1_volume, bid2, ask2, bid2_volume, bid3, ask3):
-            logging.warning(f"Пропущен треугольник {pair1} → {pair2} → {pair3} (нет данных bid/ask/volume)")
-            continue
-        
-        required_ask1_volume = 200 / ask1
-        required_bid2_volume = 200 / bid2
+    if triangle_engine is not None:
+        rows = triangle_engine.evaluate()  # Все прибыльные треугольники за один пакетный проход
+    else:
+        rows = (evaluate_triangle(pair1, pair2, pair3) for pair1, pair2, pair3 in triangles)
 
-        if ask1_volume == 0 or bid2_volume == 0:
+    for row in rows:
+        if row is None:
             continue
-        
-        if ask1_volume < required_ask1_volume or bid2_volume < required_bid2_volume:
-            continue
-        
-        step1 = INITIAL_BALANCE / ask1
-        step2 = step1 * bid2
-        final_balance = step2 * bid3
-        profit_percent = (final_balance - INITIAL_BALANCE) / INITIAL_BALANCE * 100
-        
-        status = "✅" if final_balance > INITIAL_BALANCE else "❌"
-        
+        final_balance = row[-1]
         if final_balance > PROFIT_PERCENT:
-            current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            log_entry = (f"[{current_time}]\n"
-                         f"🔹 {pair1} → {pair2} → {pair3}\n"
-                         f"   Итоговый баланс: {final_balance:.2f} ({profit_percent:.2f}%) {status}🔥\n")
-            log_entries.append(log_entry)
-            
-            successful_arbitrages.append(log_entry)
-            results.append((pair1, bid1, ask1, pair2, bid2, ask2, pair3, bid3, ask3, final_balance))
+            opportunity_log.info("opportunity", {
+                "route": row[0:9:3], "final_balance": final_balance,
+                "profit_pct": round((final_balance - INITIAL_BALANCE) / INITIAL_BALANCE * 100, 4),
+                "quotes": (*row[1:3], *row[4:6], *row[7:9]),
+            })
+            results.append(row)
     
-    cursor.execute("DELETE FROM tab_3")
+    persistence.write("DELETE FROM tab_3")
     if results:
-        cursor.executemany("INSERT INTO tab_3 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", results)
+        persistence.write_many("INSERT INTO tab_3 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", results)
     else:
-        current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        log_entries.append(f"[{current_time}] ❌ Нет арбитражей, работаем дальше.\n")
         logging.info("Нет арбитражей для записи в tab_3.")
     
-    with open("arbitrage_log.txt", "a") as log_file:
-        log_file.writelines(log_entries)
-    
-    if successful_arbitrages:
-        with open("analise_arrbitrage.txt", "a") as arb_file:
-            arb_file.writelines(successful_arbitrages)
-    conn.commit()
-    conn.close()
-    
+
+# Пакетный расчёт всех треугольников на NumPy
+class TriangleEngine:
+    """Держит ноги треугольников как массивы индексов в хранилище котировок и считает все сразу."""
+
+    def __init__(self, store, triangles):
+        self.store = store
+        self.triangles = triangles
+        legs = np.array([[store.index[pair] for pair in triangle] for triangle in triangles], dtype=np.intp)
+        legs = legs.reshape(-1, 3)
+        self.leg1, self.leg2, self.leg3 = (legs[:, k].copy() for k in range(3))
+        # Столбцы котировок без копирования: NumPy смотрит прямо в массивы хранилища
+        self.bid, self.ask, self.bid_volume, self.ask_volume = (
+            np.frombuffer(column, dtype=np.float64)
+            for column in (store.bid, store.ask, store.bid_volume, store.ask_volume)
+        )
+
+    def evaluate(self, top_k=None):
+        """Возвращает строки формата `tab_3` с final_balance > PROFIT_PERCENT, лучшие первыми."""
+        bid1, ask1, ask1_volume = self.bid[self.leg1], self.ask[self.leg1], self.ask_volume[self.leg1]
+        bid2, ask2, bid2_volume = self.bid[self.leg2], self.ask[self.leg2], self.bid_volume[self.leg2]
+        bid3, ask3 = self.bid[self.leg3], self.ask[self.leg3]
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            # Те же условия, что и в evaluate_triangle: есть данные, объём не нулевой и не меньше 200 / цена
+            has_data = ~(np.isnan(bid1) | np.isnan(ask1) | np.isnan(ask1_volume) | np.isnan(bid2)
+                         | np.isnan(ask2) | np.isnan(bid2_volume) | np.isnan(bid3) | np.isnan(ask3))
+            liquid = (has_data & (ask1_volume != 0) & (bid2_volume != 0)
+                      & (ask1_volume >= 200 / ask1) & (bid2_volume >= 200 / bid2))
+            final_balance = INITIAL_BALANCE / ask1 * bid2 * bid3
+
+        candidates = np.flatnonzero(liquid & (final_balance > PROFIT_PERCENT))
+        if top_k is not None and len(candidates) > top_k:
+            candidates = candidates[np.argpartition(-final_balance[candidates], top_k - 1)[:top_k]]
+        candidates = candidates[np.argsort(-final_balance[candidates], kind="stable")]
+
+        return [
+            (*self._row_prices(i), float(final_balance[i]))
+            for i in candidates.tolist()
+        ]
+
+    def _row_prices(self, i):
+        pair1, pair2, pair3 = self.triangles[i]
+        b1, a1, b2, a2, b3, a3 = (float(v) for v in (
+            self.bid[self.leg1[i]], self.ask[self.leg1[i]],
+            self.bid[self.leg2[i]], self.ask[self.leg2[i]],
+            self.bid[self.leg3[i]], self.ask[self.leg3[i]],
+        ))
+        return pair1, b1, a1, pair2, b2, a2, pair3, b3, a3
+
+
+# Поиск прибыльных циклов любой длины как отрицательных циклов в графе -log(курс)
+class NegativeCycleDetector:
+    """Инкрементальный SPFA: после тика релаксирует только рёбра от валют обновлённого инструмента."""
+
+    def __init__(self, instruments):
+        instruments = set(instruments)
+        edges = {}
+        for currency, neighbors in pair_map.items():
+            for other in neighbors:
+                pair = pair_lookup[(currency, other)]
+                if pair in instruments:
+                    edges[pair] = pair.split("-")
+
+        self.currencies = sorted({currency for base_quote in edges.values() for currency in base_quote})
+        node = {currency: i for i, currency in enumerate(self.currencies)}
+        n = len(self.currencies)
+
+        # Для пары BASE-QUOTE два ребра: продажа BASE → QUOTE по bid и покупка QUOTE → BASE по ask
+        self.edge_from = array("i")
+        self.edge_to = array("i")
+        self.edge_pair = []
+        self.edge_side = []
+        self.weight = array("d")
+        self.pair_edges = {}
+        self.out_edges = [[] for _ in range(n)]
+        for pair, (base, quote) in edges.items():
+            sell, buy = len(self.edge_pair), len(self.edge_pair) + 1
+            for e, src, dst, side in ((sell, base, quote, "sell"), (buy, quote, base, "buy")):
+                self.edge_from.append(node[src])
+                self.edge_to.append(node[dst])
+                self.edge_pair.append(pair)
+                self.edge_side.append(side)
+                self.weight.append(math.inf)  # Нет котировки — ребра как будто нет
+                self.out_edges[node[src]].append(e)
+            self.pair_edges[pair] = (sell, buy)
+
+        # Расстояния от виртуального истока (0 до каждой вершины)
+        self.dist = array("d", [0.0] * n)
+        self.pred = array("i", [-1] * n)
+        self.hops = array("i", [0] * n)
+        self.queue = deque()
+        self.in_queue = bytearray(n)
+
+    def reset(self):
+        n = len(self.currencies)
+        self.dist = array("d", [0.0] * n)
+        self.pred = array("i", [-1] * n)
+        self.hops = array("i", [0] * n)
+        self.queue.clear()
+        self.in_queue = bytearray(n)
+
+    def set_rate(self, e, rate):
+        weight = -math.log(rate * (1 - TRADE_FEE)) if rate > 0 else math.inf
+        old, self.weight[e] = self.weight[e], weight
+        u, v = self.edge_from[e], self.edge_to[e]
+        if weight > old and self.pred[v] == e:
+            # Ребро подорожало: путь через него больше не верен, возвращаем вершину к истоку
+            self.dist[v], self.pred[v], self.hops[v] = 0.0, -1, 0
+        if not self.in_queue[u]:
+            self.in_queue[u] = 1
+            self.queue.append(u)
+
+    def on_quote(self, pair):
+        """Обновляет рёбра инструмента, ищет цикл и отдаёт исполнимый треугольник в цикл исполнения."""
+        edges = self.pair_edges.get(pair)
+        if edges is None:
+            return
+        bid, ask, _, _ = quote_store.get(pair)
+        if bid is None or ask is None:
+            return
+        self.set_rate(edges[0], bid)
+        self.set_rate(edges[1], 1 / ask)
+
+        cycle = self.relax()
+        if cycle is None:
+            return
+        row = self.to_row(cycle)
+        if row is not None and row[-1] > PROFIT_PERCENT:
+            publish_opportunity(tuple(row[0:9:3]), row)
+        else:
+            route = " → ".join(f"{self.edge_side[e]} {self.edge_pair[e]}" for e in cycle)
+            logging.info("🔁 Найден цикл, который не исполняется тремя сделками: %s", route)
+
+    def relax(self, budget=100_000):
+        """Релаксирует рёбра из очереди; возвращает список рёбер отрицательного цикла или None."""
+        n = len(self.currencies)
+        dist, pred, hops, weight, edge_to = self.dist, self.pred, self.hops, self.weight, self.edge_to
+        while self.queue and budget > 0:
+            u = self.queue.popleft()
+            self.in_queue[u] = 0
+            for e in self.out_edges[u]:
+                budget -= 1
+                v = edge_to[e]
+                candidate = dist[u] + weight[e]
+                if candidate < dist[v] - 1e-12:
+                    dist[v], pred[v], hops[v] = candidate, e, hops[u] + 1
+                    if hops[v] >= n:
+                        return self.extract_cycle(v)
+                    if not self.in_queue[v]:
+                        self.in_queue[v] = 1
+                        self.queue.append(v)
+        return None
+
+    def extract_cycle(self, v):
+        # Цепочка предков длиной n обязательно заходит в цикл: сначала встаём на него, потом обходим
+        for _ in range(len(self.currencies)):
+            if self.pred[v] < 0:
+                self.reset()  # Цепочка оборвана сбросом вершины — цикла нет
+                return None
+            v = self.edge_from[self.pred[v]]
+        cycle, u = [], v
+        while True:
+            e = self.pred[u]
+            cycle.append(e)
+            u = self.edge_from[e]
+            if u == v:
+                break
+        cycle.reverse()
+        total = sum(self.weight[e] for e in cycle)
+        self.reset()  # Начинаем поиск заново, чтобы не находить тот же цикл повторно
+        return cycle if total < 0 else None
+
+    def to_row(self, cycle):
+        """Разворачивает цикл в строку формата `tab_3`: покупка pair1, продажа pair2, продажа pair3.
+        Цикл найден по весам с комиссией, а final_balance считается как у `evaluate_triangle` — без неё,
+        чтобы обе стратегии сравнивались с одним `PROFIT_PERCENT`."""
+        if len(cycle) != 3:
+            return None
+        for shift in range(3):
+            legs = cycle[shift:] + cycle[:shift]
+            start = self.currencies[self.edge_from[legs[0]]]
+            if [self.edge_side[e] for e in legs] == ["buy", "sell", "sell"] and start in TARGET_CURRENCIES:
+                return evaluate_triangle(*(self.edge_pair[e] for e in legs))
+        return None
+
+
+def benchmark_triangle_engine(sizes=(10_000, 100_000)):
+    """Сравнивает построчный цикл анализа и пакетный расчёт на синтетических треугольниках."""
+    if np is None:
+        print("⚠️ NumPy не установлен, сравнивать не с чем")
+        return
+    rng = random.Random(42)
+    for size in sizes:
+        n_pairs = max(30, size // 10)
+        store = QuoteStore()
+        store.register(f"C{i}-USDT" for i in range(n_pairs))
+        for pair in store.pairs:
+            price = rng.uniform(0.995, 1.005) * (1.02 if rng.random() < 0.01 else 1)  # Редкие «выбросы» цены
+            store.update(pair, price * 0.9995, price * 1.0005, rng.uniform(0, 2000), rng.uniform(0, 2000))
+        bench_triangles = [tuple(rng.sample(store.pairs, 3)) for _ in range(size)]
+
+        start = time.perf_counter()
+        loop_rows = [
+            row for row in (evaluate_triangle(*triangle, store=store) for triangle in bench_triangles)
+            if row is not None and row[-1] > PROFIT_PERCENT
+        ]
+        loop_time = time.perf_counter() - start
+
+        engine = TriangleEngine(store, bench_triangles)
+        start = time.perf_counter()
+        engine_rows = engine.evaluate()
+        engine_time = time.perf_counter() - start
+
+        same = sorted(loop_rows) == sorted(engine_rows)
+        print(f"📊 {size} треугольников: цикл {loop_time * 1000:.1f} мс, NumPy {engine_time * 1000:.1f} мс "
+              f"(x{loop_time / engine_time:.0f}), найдено {len(engine_rows)}, совпадает: {'✅' if same else '❌'}")
+
+
+def benchmark_decoders(updates=20_000, snapshots=1_000, depth=400):
+    """Сообщений в секунду для каждой реализации разбора: только разбор и разбор + применение к стакану."""
+    rng = random.Random(7)
+    level = lambda price: [f"{price:.4f}", f"{rng.uniform(0.1, 50):.4f}", "0", "1"]
+    snapshot = json.dumps({
+        "arg": {"channel": "books", "instId": "BTC-USDT"}, "action": "snapshot",
+        "data": [{"bids": [level(100 - k * 0.01) for k in range(depth)],
+                  "asks": [level(100.01 + k * 0.01) for k in range(depth)],
+                  "ts": "0", "checksum": 0, "seqId": 1, "prevSeqId": -1}],
+    })
+    frames = []
+    for seq in range(2, updates + 2):
+        frames.append(json.dumps({
+            "arg": {"channel": "books", "instId": "BTC-USDT"}, "action": "update",
+            "data": [{"bids": [level(100 - rng.randrange(20) * 0.01)], "asks": [level(100.01 + rng.randrange(20) * 0.01)],
+                      "ts": "0", "checksum": 0, "seqId": seq, "prevSeqId": seq - 1}],
+        }))
+
+    backends = [(name, False) for name in json_backends()]
+    if msgspec is not None:
+        backends.append(("msgspec", True))
+    for name, lazy in backends:
+        decode = make_frame_decoder(name, lazy)
+        label = f"{name}{' (lazy)' if lazy else ''}"
+
+        start = time.perf_counter()
+        for _ in range(snapshots):
+            decode(snapshot)
+        snapshot_rate = snapshots / (time.perf_counter() - start)
+        start = time.perf_counter()
+        for frame in frames:
+            decode(frame)
+        update_rate = updates / (time.perf_counter() - start)
+
+        # Контрольная сумма синтетическая, поэтому сравниваем только разбор и обновление уровней
+        book = OrderBook("BTC-USDT")
+        start = time.perf_counter()
+        for _ in range(snapshots):
+            data = decode(snapshot)["data"][0]
+            data.pop("checksum", None)
+            book.apply("snapshot", data)
+        snapshot_apply_rate = snapshots / (time.perf_counter() - start)
+        start = time.perf_counter()
+        for frame in frames:
+            data = decode(frame)["data"][0]
+            data.pop("checksum", None)
+            book.apply("update", data)
+        update_apply_rate = updates / (time.perf_counter() - start)
+
+        print(f"📊 {label:15} снимок {depth} ур.: {snapshot_rate:8,.0f}/с, с применением {snapshot_apply_rate:6,.0f}/с | "
+              f"обновление: {update_rate:8,.0f}/с, с применением {update_apply_rate:7,.0f}/с")
 
 
 def generate_signature(timestamp, method, path, body, secret_key):
@@ -447,88 +2580,12 @@ def generate_signature(timestamp, method, path, body, secret_key):
 
 os.environ["SSL_CERT_FILE"] = certifi.where()
 
-# Подписка на Websocket для доступа к балансу и списку ордеров
-async def subscribe_private_ws():
-    api_key, api_secret, passphrase = load_api_keys()
-    ssl_context = ssl.create_default_context(cafile=certifi.where())
-
-    retry_delay = 5  # Начальная задержка на переподключение
-    max_delay = 60   # Максимальная задержка между попытками
-
-    while True:
-        try:
-            async with websockets.connect(
-                OKX_PRIVAT_URL, ssl=ssl_context, timeout=10, ping_interval=15, ping_timeout=10
-            ) as ws:
-                logging.error("✅ Подключение к WebSocket баланса и ордеров установлено")
-
-                # Генерируем подпись
-                timestamp = str(int(time.time()))
-                signature = generate_signature(timestamp, "GET", "/users/self/verify", "", api_secret)
-
-                # 🔹 1. Аутентификация
-                auth_msg = {
-                    "op": "login",
-                    "args": [{
-                        "apiKey": api_key,
-                        "passphrase": passphrase,
-                        "timestamp": timestamp,
-                        "sign": signature
-                    }]
-                }
-                logging.info(f"📤 Отправка аутентификации: {auth_msg}")
-                await ws.send(json.dumps(auth_msg))
-
-                # Получаем ответ на аутентификацию
-                response = await ws.recv()
-                logging.info(f"📥 Ответ от сервера (аутентификация): {response}")
-
-                # 🔹 2. Подписка на баланс и ордера
-                subscribe_msg = {
-                    "op": "subscribe",
-                    "args": [
-                        {"channel": "account"},  # Баланс
-                        {"channel": "orders", "instType": "SPOT"}  # Открытые ордера
-                    ]
-                }
-                logging.info(f"📤 Отправка подписки: {subscribe_msg}")
-                await ws.send(json.dumps(subscribe_msg))
-
-                # Бесконечный цикл получения данных
-                async for message in ws:
-                    logging.info(f"📥 Получено сообщение: {message}")
-                    await process_private_ws_message(message)
-
-        except websockets.exceptions.ConnectionClosed as e:
-            logging.error(f"⚠️ WebSocket баланса и ордеров закрыт (код {e.code}): {e.reason}")
-            if e.code == 1000:
-                logging.error("✅ Нормальное завершение соединения, не переподключаемся")
-                break  # Если сервер закрыл соединение штатно, выходим
-
-        except asyncio.TimeoutError:
-            logging.error("⏳ Ошибка: WebSocket(баланса и ордеров)-соединение не установлено (таймаут)")
-
-        except Exception as e:
-            logging.error(f"🚨 Критическая ошибка WebSocket баланса и ордеров: {e}")
-            print("❌ СКРИПТ ОСТАНОВЛЕН ИЗ-ЗА ОШИБКИ ❌")  # Вывод в консоль
-            traceback.print_exc()
-            break  # Полностью останавливаем скрипт
-
-        logging.error(f"🔄 Переподключение баланса и ордеров через {retry_delay} сек...")
-        await asyncio.sleep(retry_delay)
-
-        # Увеличиваем задержку при частых ошибках, но не более max_delay
-        retry_delay = min(retry_delay * 2, max_delay)
-
 async def process_private_ws_message(message):
-    """ Обрабатывает входящие сообщения от приватного WebSocket-а """
+    """ Обрабатывает входящие сообщения от приватного WebSocket-а (строка или уже разобранный dict) """
     try:
-        data = json.loads(message)
+        data = decode_json(message) if isinstance(message, (str, bytes)) else message
         if "arg" in data and "data" in data:
             channel = data["arg"]["channel"]
-            
-            conn = sqlite3.connect("arbitrage.db")
-            cursor = conn.cursor()
 
             if channel == "account":
                 logging.info("🔄 Обновление баланса...")
@@ -536,17 +2593,11 @@ async def process_private_ws_message(message):
                 for account_data in data.get("data", []):  # ✅ Избегаем KeyError
                     for balance in account_data.get("details", []):  # ✅ Избегаем KeyError
                         currency = balance["ccy"] 
-                        available = float(balance.get("availBal", 0))
-                        reserved = float(balance.get("frozenBal", 0))
-
-                        logging.info(f"💰 Баланс обновлён: {currency} | Доступно: {available} | Зарезервировано: {reserved}")
+                        available = float(balance.get("availBal") or 0)
+                        reserved = float(balance.get("frozenBal") or 0)
 
-                        cursor.execute("""
-                            INSERT INTO balances (currency, available, reserved) 
-                            VALUES (?, ?, ?)
-                            ON CONFLICT(currency) DO UPDATE 
-                            SET available = excluded.available, reserved = excluded.reserved
-                        """, (currency, available, reserved))
+                        logging.info("💰 Баланс обновлён: %s | Доступно: %s | Зарезервировано: %s", currency, available, reserved)
+                        update_balance(currency, available, reserved)
 
             elif channel == "orders":
                 logging.info("🔄 Обновление списка ордеров...")
@@ -558,57 +2609,391 @@ async def process_private_ws_message(message):
                     quantity = float(order["sz"])
                     created_at = order["cTime"]
 
-                    logging.info(f"📜 Ордер обновлён: {order_id} | {pair} | {order_type} | Цена: {price} | Кол-во: {quantity}")
+                    state = order.get("state")
 
-                    cursor.execute("""
-                        INSERT INTO open_orders (order_id, pair, type, price, quantity, created_at)
-                        VALUES (?, ?, ?, ?, ?, ?)
-                        ON CONFLICT(order_id) DO UPDATE 
-                        SET price = excluded.price, quantity = excluded.quantity
-                    """, (order_id, pair, order_type, price, quantity, created_at))
-            
-            conn.commit()
-            conn.close()
+                    logging.info("📜 Ордер обновлён: %s | %s | %s | Цена: %s | Кол-во: %s | %s",
+                                 order_id, pair, order_type, price, quantity, state)
+
+                    if state in ORDER_FINAL_STATES:
+                        # Ордер закрыт: будим ожидающего и убираем из открытых
+                        fill = OrderFill(
+                            order_id, pair, order_type, state,
+                            float(order.get("accFillSz") or 0), float(order.get("avgPx") or 0),
+                            float(order.get("fee") or 0), order.get("feeCcy"),
+                        )
+                        resolve_order(fill)
+                        persistence.write(DELETE_OPEN_ORDER, (order_id,))
+                        persistence.write(INSERT_FILL, (*fill, time.time()))
+                        continue
+
+                    persistence.write(UPSERT_OPEN_ORDER, (order_id, pair, order_type, price, quantity, created_at))
     except Exception as e:
         logging.error(f"❌ Ошибка обработки WebSocket-сообщения: {e}")
         traceback.print_exc()
 
-def run_ws():
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    loop.run_until_complete(subscribe_private_ws())
-
-
-balances = {}  # Глобальный кеш балансов
-API_KEY, API_SECRET, PASSPHRASE = load_api_keys()
 
+# Запись сырого потока WebSocket и воспроизведение для профилирования и регрессионных прогонов
+# Формат: заголовок FEED_MAGIC + флаги, затем записи <длина, время приёма (нс), источник> + сообщение.
+# При сжатии записи группируются в блоки <длина сжатого, длина исходного> + zlib.
+FEED_MAGIC = b"OKXFEED1"
+FEED_HEADER = struct.Struct("<8sB")
+FEED_RECORD = struct.Struct("<IqB")
+FEED_CHUNK = struct.Struct("<II")
+FEED_FLAG_COMPRESSED = 1
+SOURCE_PUBLIC, SOURCE_PRIVATE = 0, 1
+
+class MarketRecorder:
+    """Дописывает сообщения в бинарный журнал; безопасен для вызова из нескольких потоков."""
+
+    def __init__(self, path, compress=RECORD_COMPRESS, chunk_size=1 << 20):
+        self.compress = compress
+        self.chunk_size = chunk_size
+        self.buffer = bytearray()
+        self.lock = threading.Lock()
+        self.file = open(path, "ab")
+        if self.file.tell() == 0:
+            self.file.write(FEED_HEADER.pack(FEED_MAGIC, FEED_FLAG_COMPRESSED if compress else 0))
+        atexit.register(self.close)
+
+    def write(self, source, message):
+        payload = message.encode() if isinstance(message, str) else message
+        received_at = time.time_ns()
+        with self.lock:
+            self.buffer += FEED_RECORD.pack(len(payload), received_at, source)
+            self.buffer += payload
+            if len(self.buffer) >= self.chunk_size:
+                self._flush_buffer()
+
+    def _flush_buffer(self):
+        if not self.buffer:
+            return
+        if self.compress:
+            packed = zlib.compress(self.buffer, 1)
+            self.file.write(FEED_CHUNK.pack(len(packed), len(self.buffer)))
+            self.file.write(packed)
+        else:
+            self.file.write(self.buffer)
+        self.buffer.clear()
+
+    def flush(self):
+        with self.lock:
+            self._flush_buffer()
+            self.file.flush()
+
+    def close(self):
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
+
+
+feed_recorder = None  # MarketRecorder, если задан RECORD_PATH
+
+def iter_feed(path):
+    """Читает журнал через mmap и отдаёт записи (время приёма в нс, источник, сообщение в байтах)."""
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        magic, flags = FEED_HEADER.unpack_from(data, 0)
+        if magic != FEED_MAGIC:
+            raise ValueError(f"{path}: это не журнал потока OKX")
+        offset = FEED_HEADER.size
+
+        def records(block, start, end):
+            while start < end:
+                length, received_at, source = FEED_RECORD.unpack_from(block, start)
+                start += FEED_RECORD.size
+                yield received_at, source, bytes(block[start:start + length])
+                start += length
+
+        if flags & FEED_FLAG_COMPRESSED:
+            while offset < len(data):
+                packed_length, raw_length = FEED_CHUNK.unpack_from(data, offset)
+                offset += FEED_CHUNK.size
+                block = zlib.decompress(data[offset:offset + packed_length])
+                offset += packed_length
+                yield from records(block, 0, raw_length)
+        else:
+            yield from records(data, offset, len(data))
+
+async def replay_feed(path, speed=1.0):
+    """Прогоняет журнал через обработчики WebSocket: speed=1 — в реальном темпе, >1 — быстрее, 0 — без пауз."""
+    started = time.perf_counter()
+    first_ts = None
+    count = 0
+    for received_at, source, message in iter_feed(path):
+        if first_ts is None:
+            first_ts = received_at
+        if speed > 0:
+            delay = (received_at - first_ts) / 1e9 / speed - (time.perf_counter() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        if source == SOURCE_PUBLIC:
+            await process_ws_message(message)
+        else:
+            await process_private_ws_message(message)
+        count += 1
+    elapsed = time.perf_counter() - started
+    print(f"▶️ Воспроизведено {count} сообщений за {elapsed:.2f} сек ({count / max(elapsed, 1e-9):.0f} сообщ./сек)")
+
+
+# Бэктест по записанным стаканам: та же оценка треугольников и та же логика ног, исполнение — симуляция
+def simulate_market_order(pair, side, amount):
+    """Рыночный ордер против локального стакана: buy тратит `amount` валюты котировки, sell продаёт `amount` базовой.
+    Возвращает (исполнено во входной валюте, получено за вычетом TRADE_FEE)."""
+    book = order_books.get(pair)
+    if book is None:
+        return 0.0, 0.0
+    spent = received = 0.0
+    for price, size in (book.asks() if side == "buy" else book.bids()):
+        capacity = price * size if side == "buy" else size
+        take = min(capacity, amount - spent)
+        spent += take
+        received += take / price if side == "buy" else take * price
+        if spent >= amount:
+            break
+    return spent, received * (1 - TRADE_FEE)
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+def run_backtest(path, profit_threshold=PROFIT_PERCENT, order_size=ORDER_SIZE, capital=INITIAL_BALANCE,
+                 latency_ms=50.0, targets=TARGET_CURRENCIES, targets2=TARGET_CURRENCIES2):
+    """Прогоняет журнал потока через стратегию и симулирует исполнение трёх ног с задержкой `latency_ms` на ногу
+    (число — одна на все ноги, или три значения по ногам). По каждой ноге считается проскальзывание исполнения
+    относительно цены, заложенной в оценку."""
+    with sqlite3.connect("arbitrage.db") as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT pair FROM tab_1")
+        build_currency_graph([row[0] for row in cursor.fetchall()])
+    set_triangles(
+        triangle for triangle in (cycle_pairs(cycle) for cycle in find_cycles(3))
+        if triangle_passes_filter(*triangle, targets=targets, targets2=targets2)
+    )
+    order_books.clear()
+
+    leg_latency_ms = tuple(latency_ms) if isinstance(latency_ms, (tuple, list)) else (latency_ms,) * 3
+    leg_latency_ns = [int(ms * 1e6) for ms in leg_latency_ms]
+    slippage = ([], [], [])  # По ногам: цена исполнения хуже оценки на столько б.п. (минус — лучше)
+    open_since = {}  # номер треугольника -> время появления возможности
+    lifetimes = []
+    stats = {"updates": 0, "opportunities": 0, "executed": 0, "hits": 0, "pnl": 0.0,
+             "missed_busy": 0, "missed_size": 0, "missed_route": 0, "unfilled": 0}
+    # [время следующей ноги, номер ноги, треугольник, вложено, сумма на входе ноги, оценка из size_triangle]
+    execution = None
+
+    def run_due_legs(now):
+        nonlocal execution
+        while execution is not None and execution[0] <= now:
+            due, leg, triangle, invested, amount, sizing = execution
+            side = "buy" if leg == 0 else "sell"
+            spent, received = simulate_market_order(triangle[leg], side, amount)
+            if spent < amount * 0.999999:
+                stats["unfilled"] += 1  # Стакан не выдержал объём, остаток остаётся на руках
+            if spent > 0 and received > 0:
+                gross = received / (1 - TRADE_FEE)
+                price, expected = (spent / gross if side == "buy" else gross / spent), sizing[3 + leg]
+                slippage[leg].append((price / expected - 1 if side == "buy" else 1 - price / expected) * 1e4)
+            if leg < 2:
+                execution = [due + leg_latency_ns[leg + 1], leg + 1, triangle, invested, received, sizing]
+                continue
+            profit = received - invested
+            stats["pnl"] += profit
+            stats["hits"] += profit > 0
+            execution = None
+
+    started = time.perf_counter()
+    last_ts = 0
+    for received_at, source, message in iter_feed(path):
+        if source != SOURCE_PUBLIC:
+            continue
+        last_ts = received_at
+        run_due_legs(received_at)
+        data = decode_frame(message)
+        if "arg" not in data or "data" not in data:
+            continue
+        if not BOOK_PARSERS.get(data["arg"].get("channel"), apply_book_message)(data):
+            continue
+        stats["updates"] += 1
+
+        for i in pair_triangles.get(data["arg"]["instId"], ()):
+            row = evaluate_triangle(*triangles[i])
+            if row is None or row[-1] <= profit_threshold:
+                since = open_since.pop(i, None)
+                if since is not None:
+                    lifetimes.append((received_at - since) / 1e6)
+                continue
+            if i in open_since:
+                continue  # Та же возможность ещё жива
+            open_since[i] = received_at
+            stats["opportunities"] += 1
+            if not triangle_chains(*triangles[i]):
+                stats["missed_route"] += 1  # Исполнитель такой маршрут не проведёт: валюты ног не совпадают
+                continue
+            if execution is not None:
+                stats["missed_busy"] += 1
+                continue
+            sizing = size_triangle(*triangles[i], max_notional=capital)
+            if sizing is None or sizing.profit <= 0 or sizing.notional < order_size:
+                stats["missed_size"] += 1
+                continue
+            stats["executed"] += 1
+            execution = [received_at + leg_latency_ns[0], 0, triangles[i], sizing.notional, sizing.notional, sizing]
+
+    run_due_legs(math.inf)
+    lifetimes.extend((last_ts - since) / 1e6 for since in open_since.values())
+    lifetimes.sort()
+    elapsed = time.perf_counter() - started
+    stats.update({
+        "seconds": elapsed,
+        "updates_per_minute": stats["updates"] / max(elapsed, 1e-9) * 60,
+        "hit_rate": stats["hits"] / stats["executed"] if stats["executed"] else 0.0,
+        "lifetime_ms_p50": percentile(lifetimes, 0.5),
+        "lifetime_ms_p90": percentile(lifetimes, 0.9),
+        "lifetime_ms_p99": percentile(lifetimes, 0.99),
+        "lifetime_ms_max": lifetimes[-1] if lifetimes else 0.0,
+    })
+    for leg, values in enumerate(slippage, 1):
+        values.sort()
+        stats[f"leg{leg}_latency_ms"] = leg_latency_ms[leg - 1]
+        stats[f"leg{leg}_slippage_bps_p50"] = percentile(values, 0.5)
+        stats[f"leg{leg}_slippage_bps_p90"] = percentile(values, 0.9)
+    return stats
+
+def sweep_backtest(path, options):
+    """Перебирает все сочетания параметров вида {"profit": [1005, 1010], "latency": [20, 50], ...}."""
+    names = {"profit": "profit_threshold", "order_size": "order_size", "capital": "capital", "latency": "latency_ms"}
+    grid = [{}]
+    for key, values in options.items():
+        grid = [dict(params, **{key: value}) for params in grid for value in values]
+    for params in grid:
+        # Задержка по ногам: latency=20/50/30
+        kwargs = {names[key]: tuple(map(float, value.split("/"))) if "/" in value else float(value)
+                  for key, value in params.items() if key in names}
+        if "targets" in params:
+            kwargs["targets"] = set(params["targets"].split("+"))
+        if "targets2" in params:
+            kwargs["targets2"] = set(params["targets2"].split("+"))
+        stats = run_backtest(path, **kwargs)
+        print(f"🧪 {params or 'по умолчанию'}: PnL {stats['pnl']:.4f}, сделок {stats['executed']}, "
+              f"попаданий {stats['hit_rate']:.0%}, возможностей {stats['opportunities']}, "
+              f"пропущено {stats['missed_busy']} (занят) / {stats['missed_size']} (объём) / "
+              f"{stats['missed_route']} (маршрут), "
+              f"жизнь p50/p90/p99 {stats['lifetime_ms_p50']:.0f}/{stats['lifetime_ms_p90']:.0f}/"
+              f"{stats['lifetime_ms_p99']:.0f} мс, {stats['updates_per_minute']:.0f} обновл./мин")
+        print("   ноги (задержка мс → проскальзывание p50/p90 б.п.): " + ", ".join(
+            f"{stats[f'leg{leg}_latency_ms']:.0f} → {stats[f'leg{leg}_slippage_bps_p50']:.1f}/"
+            f"{stats[f'leg{leg}_slippage_bps_p90']:.1f}" for leg in (1, 2, 3)))
+
+
+API_KEY = API_SECRET = PASSPHRASE = None  # Загружает `init()` — процессам приёма стаканов ключи не нужны
+
+def init():
+    """Побочные эффекты запуска бота: схема БД и API-ключи. Вызывается только из `__main__`."""
+    global API_KEY, API_SECRET, PASSPHRASE
+    init_database()
+    API_KEY, API_SECRET, PASSPHRASE = load_api_keys()
+
+# Кеш балансов в памяти: источник истины — приватный канал `account`
+balances = {}  # валюта -> (доступно, зарезервировано)
+balance_versions = {}  # валюта -> номер версии, растёт с каждым обновлением
+balance_waiters = {}  # валюта -> [(цикл событий, Future)] ожидающих `wait_for_balance_change`
+balance_lock = threading.Lock()
+
+def update_balance(currency, available, reserved):
+    """Обновляет баланс в памяти, повышает версию и будит ожидающих (вызывается из потока WebSocket)."""
+    with balance_lock:
+        balances[currency] = (available, reserved)
+        version = balance_versions.get(currency, 0) + 1
+        balance_versions[currency] = version
+        waiters = balance_waiters.pop(currency, ())
+    persistence.write(UPSERT_BALANCE, (currency, available, reserved))
+    for loop, future in waiters:
+        loop.call_soon_threadsafe(set_future_result, future, (available, version))
 
 async def get_balance(currency):
-    """Возвращает актуальный баланс для указанной валюты из локальной БД"""
-    conn = sqlite3.connect("arbitrage.db")
-    cursor = conn.cursor()
-    cursor.execute("SELECT available FROM balances WHERE currency = ?", (currency,))
-    result = cursor.fetchone()
-    conn.close()
-    return float(result[0]) if result else 0.0  # Если валюты нет, возвращаем 0
-
-async def wait_for_order(order_id):
-    """Ждёт выполнения ордера по `order_id`, проверяя таблицу `open_orders`"""
-    while True:
-        conn = sqlite3.connect("arbitrage.db")
-        cursor = conn.cursor()
-        cursor.execute("SELECT order_id FROM open_orders WHERE order_id = ?", (order_id,))
-        open_order = cursor.fetchone()
-        conn.close()
+    """Возвращает доступный баланс валюты из памяти (0, если валюты нет)."""
+    return balances.get(currency, (0.0, 0.0))[0]
+
+def get_balance_version(currency):
+    return balance_versions.get(currency, 0)
+
+async def wait_for_balance_change(currency, version=None, timeout=None):
+    """Ждёт версию баланса новее `version` (по умолчанию — текущей). Возвращает (доступно, версия) или None по таймауту."""
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    with balance_lock:
+        current = balance_versions.get(currency, 0)
+        if version is not None and current > version:
+            return balances[currency][0], current
+        balance_waiters.setdefault(currency, []).append((loop, future))
+    try:
+        return await asyncio.wait_for(future, timeout)
+    except asyncio.TimeoutError:
+        with balance_lock:
+            waiters = balance_waiters.get(currency, [])
+            if (loop, future) in waiters:
+                waiters.remove((loop, future))
+        return None
 
-        if not open_order:
-            logging.info(f"✅ Ордер {order_id} исполнен!")
-            return True  # Ордер выполнен
-        await asyncio.sleep(0.2)  # Проверяем статус каждую секунду
+# Уведомления об исполнении ордеров из канала `orders` (без опроса SQLite)
+OrderFill = namedtuple("OrderFill", "order_id pair side state filled_size avg_price fee fee_currency")
+ORDER_FINAL_STATES = {"filled", "canceled", "mmp_canceled"}
+order_waiters = {}  # ordId -> (цикл событий, Future) ожидающего `wait_for_order`
+order_results = {}  # ordId -> OrderFill, если исполнение пришло раньше, чем его начали ждать
+order_lock = threading.Lock()
+
+def resolve_order(fill):
+    """Передаёт финальное состояние ордера ожидающему (вызывается из потока приватного WebSocket)."""
+    with order_lock:
+        waiter = order_waiters.pop(fill.order_id, None)
+        if waiter is None:
+            order_results[fill.order_id] = fill
+            if len(order_results) > 1000:
+                order_results.pop(next(iter(order_results)))  # Не копим чужие и старые ордера
+            return
+    loop, future = waiter
+    loop.call_soon_threadsafe(set_future_result, future, fill)
+
+def set_future_result(future, value):
+    if not future.done():
+        future.set_result(value)
+
+def fill_received(fill):
+    """Сколько валюты реально получено по ордеру за вычетом комиссии."""
+    base, quote = fill.pair.split("-")
+    if fill.side == "buy":
+        amount, currency = fill.filled_size, base
+    else:
+        amount, currency = fill.filled_size * fill.avg_price, quote
+    if fill.fee_currency == currency:
+        amount += fill.fee  # OKX присылает комиссию отрицательным числом
+    return amount
+
+async def wait_for_order(order_id, timeout=ORDER_FILL_TIMEOUT):
+    """Ждёт финального состояния ордера (`filled` / `canceled`) и возвращает OrderFill или None по таймауту."""
+    started_ns = time.perf_counter_ns()
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    with order_lock:
+        fill = order_results.pop(order_id, None)
+        if fill is None:
+            order_waiters[order_id] = (loop, future)
+
+    if fill is None:
+        try:
+            fill = await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            logging.error(f"⏳ Ордер {order_id} не получил финального состояния за {timeout} сек")
+            return None
+        finally:
+            with order_lock:
+                order_waiters.pop(order_id, None)
 
+    record_latency("order_fill", started_ns)
+    logging.info("✅ Ордер %s: %s, исполнено %s по %s", order_id, fill.state, fill.filled_size, fill.avg_price)
+    trade_log.info("fill", fill._asdict())
+    return fill
 
-balances = {}  # Глобальный кеш балансов
-API_KEY, API_SECRET, PASSPHRASE = load_api_keys()
 
 # ✅ Функция отправки ордера на OKX
 def generate_signature(timestamp, method, request_path, body, api_secret):
@@ -617,177 +3002,841 @@ def generate_signature(timestamp, method, request_path, body, api_secret):
     return base64.b64encode(signature).decode()
 
 
-async def place_order(pair, side, quantity):
-    """
-    Подключается по WebSocket, аутентифицируется и отправляет ордер.
-    """
-    try:
-        # Настройка SSL для WebSocket
-        ssl_context = ssl.create_default_context()
-        ssl_context.load_verify_locations(certifi.where())
+# Единственная приватная сессия: один логин на всё время работы — ордера, баланс и исполнения
+PRIVATE_CHANNELS = [{"channel": "account"}, {"channel": "orders", "instType": "SPOT"}]
 
-        # Используем правильный формат времени
-        timestamp = str(int(time.time()))  # ✅ Исправлено: теперь в секундах
+class TradeSession:
+    """Авторизованный приватный WebSocket с heartbeat, сопоставлением ответов по `id` и переподключением.
+    На том же соединении — подписка на `account` и `orders`."""
 
-        request_path = "/users/self/verify"  # ✅ Исправлено
-        method = "GET"
+    def __init__(self, url=OKX_PRIVAT_URL):
+        self.url = url
+        self.ws = None
+        self.pending = {}  # id запроса -> Future с ответом биржи
+        self.ready = asyncio.Event()  # Соединение открыто и логин пройден
+        self.task = None
 
-        # Генерируем подпись по рабочему алгоритму
-        sign = generate_signature(timestamp, method, request_path, "", API_SECRET)
+    def start(self):
+        """Запускает фоновое соединение в текущем цикле событий, если его ещё не запустил рантайм."""
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+        return self.task
 
-        # Формируем сообщение для логина (аутентификации)
+    async def login(self, ws):
+        timestamp = str(int(time.time()))
+        sign = generate_signature(timestamp, "GET", "/users/self/verify", "", API_SECRET)
         login_msg = {
             "op": "login",
-            "args": [{
-                "apiKey": API_KEY,
-                "passphrase": PASSPHRASE,
-                "timestamp": timestamp,
-                "sign": sign
-            }]
+            "args": [{"apiKey": API_KEY, "passphrase": PASSPHRASE, "timestamp": timestamp, "sign": sign}]
         }
+        await ws.send(json.dumps(login_msg, separators=(",", ":")))
+        response = json.loads(await asyncio.wait_for(ws.recv(), ORDER_REPLY_TIMEOUT))
+        if response.get("event") != "login" or response.get("code") != "0":
+            raise ConnectionError(f"логин отклонён: {response}")
+
+    async def run(self):
+        self.task = asyncio.current_task()
+        retry_delay = 1  # Торговое соединение восстанавливаем быстрее, чем ценовые
+        max_delay = 30
+        ssl_context = ws_ssl_context(self.url)
+
+        while True:
+            heartbeat = None
+            try:
+                async with websockets.connect(self.url, ssl=ssl_context, ping_interval=None) as ws:
+                    await self.login(ws)
+                    # Баланс и ордера — на том же соединении; снимок баланса придёт сразу после подписки
+                    await ws.send(json.dumps({"op": "subscribe", "args": PRIVATE_CHANNELS}, separators=(",", ":")))
+                    self.ws = ws
+                    self.ready.set()
+                    retry_delay = 1
+                    logging.error("✅ Приватная сессия WebSocket открыта: логин пройден, подписка на баланс и ордера")
+                    heartbeat = asyncio.create_task(self.heartbeat(ws))
+
+                    async for message in ws:
+                        if message == "pong":
+                            continue
+                        reply = decode_json(message)
+                        if "arg" in reply and "data" in reply:
+                            if feed_recorder is not None:
+                                feed_recorder.write(SOURCE_PRIVATE, message)
+                            await process_private_ws_message(reply)
+                            continue
+                        future = self.pending.pop(reply.get("id"), None)
+                        if future is not None and not future.done():
+                            future.set_result(reply)
+                        elif reply.get("event") == "error":
+                            logging.error(f"🚨 Ошибка торговой сессии: {reply}")
+
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"⚠️ Торговая сессия прервана: {e}")
+            finally:
+                self.ready.clear()
+                self.ws = None
+                if heartbeat is not None:
+                    heartbeat.cancel()
+                # Ответов на отправленные запросы уже не будет
+                for future in self.pending.values():
+                    if not future.done():
+                        future.set_exception(ConnectionError("торговая сессия переподключается"))
+                self.pending.clear()
+
+            logging.error(f"🔄 Переподключение торговой сессии через {retry_delay} сек...")
+            await asyncio.sleep(retry_delay)
+            retry_delay = min(retry_delay * 2, max_delay)
+
+    async def heartbeat(self, ws):
+        while True:
+            await asyncio.sleep(TRADE_HEARTBEAT_INTERVAL)
+            await ws.send("ping")
+
+    async def request(self, op, args, timeout=ORDER_REPLY_TIMEOUT):
+        """Отправляет запрос и ждёт ответ с тем же `id`; одновременно в полёте может быть много запросов."""
+        self.start()
+        await asyncio.wait_for(self.ready.wait(), timeout)
+        request_id = uuid.uuid4().hex  # Уникальный id до 32 символов, как требует OKX
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        try:
+            await self.ws.send(json.dumps({"id": request_id, "op": op, "args": args}, separators=(",", ":")))
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self.pending.pop(request_id, None)
 
-        # Формируем сообщение ордера
-        order_msg = {
-            "id": "order1",  # Идентификатор запроса
-            "op": "order",
-            "args": [{
-                "instId": pair,
-                "tdMode": "cash",   # Спотовая торговля
-                "side": side,       # "buy" или "sell"
-                "ordType": "market", # Лимитный ордер,
-                "sz": str(quantity)
-            }]
-        }
 
-        async with websockets.connect(OKX_PRIVAT_URL, ssl=ssl_context) as ws:
-            # Отправляем логин
-            await ws.send(json.dumps(login_msg, separators=(",", ":")))
-            login_response = await ws.recv()
-            logging.info(f"🔒 Ответ логина: {login_response}")
+trade_session = TradeSession()
 
-            if '"event":"error"' in login_response:
-                logging.error("🚨 Ошибка логина! Проверь API-ключи или временную метку.")
-                return None
-            
-            # После успешного логина отправляем ордер
-            await ws.send(json.dumps(order_msg, separators=(",", ":")))
-            order_response = await ws.recv()
-            logging.info(f"📩 Ответ ордера: {order_response}")
 
-            return order_response
+def market_order_args(pair, side, quantity):
+    return {
+        "instId": pair,
+        "tdMode": "cash",   # Спотовая торговля
+        "side": side,       # "buy" или "sell"
+        "ordType": "market", # Рыночный ордер
+        "sz": str(quantity)
+    }
+
+async def place_order(pair, side, quantity):
+    """
+    Отправляет рыночный ордер через постоянную торговую сессию и возвращает `ordId` (или None).
+    `quantity` — строка из `order_size`, уже округлённая по правилам инструмента.
+    """
+    try:
+        sent_ns = time.perf_counter_ns()
+        order_response = await trade_session.request("order", [market_order_args(pair, side, quantity)])
+        record_latency("order_ack", sent_ns)
+        logging.info("📩 Ответ ордера: %s", order_response)
+
+        result = (order_response.get("data") or [{}])[0]
+        if order_response.get("code") != "0" or result.get("sCode") != "0":
+            logging.error(f"🚨 Ордер {side} {pair} отклонён: {result.get('sMsg') or order_response.get('msg')}")
+            return None
+        return result["ordId"]
 
     except Exception as e:
         print(f"🚨 Ошибка в WebSocket ордере: {e}")
         return None
-    
+
+async def place_orders(legs):
+    """
+    Отправляет несколько рыночных ордеров одним кадром `batch-orders`.
+    `legs` — [(инструмент, сторона, sz)]; возвращает `ordId` в том же порядке (None — ордер отклонён).
+    """
+    try:
+        sent_ns = time.perf_counter_ns()
+        response = await trade_session.request("batch-orders", [market_order_args(*leg) for leg in legs])
+        record_latency("order_ack", sent_ns)
+        logging.info("📩 Ответ пакета ордеров: %s", response)
+    except Exception as e:
+        logging.error(f"🚨 Ошибка отправки пакета ордеров: {e}")
+        return [None] * len(legs)
+
+    results = response.get("data") or []
+    order_ids = []
+    for k, (pair, side, _) in enumerate(legs):
+        result = results[k] if k < len(results) else {}
+        if result.get("sCode") == "0" and result.get("ordId"):
+            order_ids.append(result["ordId"])
+        else:
+            logging.error(f"🚨 Ордер {side} {pair} из пакета отклонён: {result.get('sMsg') or response.get('msg')}")
+            order_ids.append(None)
+    return order_ids
+
+
+# Запас валют для параллельного исполнения: цели, полосы и фоновое выравнивание
+inventory_lock = None  # asyncio.Lock: параллельная сделка и ребалансировка не двигают запас одновременно
+
+def inventory_band(currency):
+    """(нижняя, верхняя) граница запаса валюты или None, если цель не задана."""
+    target = INVENTORY_TARGETS.get(currency)
+    if target is None:
+        return None
+    band = INVENTORY_BANDS.get(currency, INVENTORY_BAND)
+    return target * (1 - band), target * (1 + band)
+
+def inventory_report():
+    """Запас по каждой валюте с целью: баланс, цель и полоса."""
+    lines = []
+    for currency, target in INVENTORY_TARGETS.items():
+        low, high = inventory_band(currency)
+        balance = balances.get(currency, (0.0, 0.0))[0]
+        status = "✅" if low <= balance <= high else "⚠️"
+        lines.append(f"{status} {currency}: {balance:.8g} (цель {target:.8g}, полоса {low:.8g}…{high:.8g})")
+    return lines
+
+def rebalance_pair(currency):
+    """Инструмент между валютой и `INVENTORY_ANCHOR`, на который есть котировки."""
+    for pair in (f"{currency}-{INVENTORY_ANCHOR}", f"{INVENTORY_ANCHOR}-{currency}"):
+        if pair in quote_store.index:
+            return pair
+    return None
+
+async def rebalance_currency(currency):
+    """Возвращает запас валюты к цели одной рыночной сделкой, если он вышел из полосы."""
+    low, high = inventory_band(currency)
+    balance = await get_balance(currency)
+    if low <= balance <= high:
+        return
+    pair = rebalance_pair(currency)
+    if pair is None:
+        logging.warning("⚠️ Нет инструмента %s/%s для ребалансировки", currency, INVENTORY_ANCHOR)
+        return
+    bid, ask, _, _ = quote_store.get(pair)
+    if not bid or not ask:
+        return
+
+    excess = balance - INVENTORY_TARGETS[currency]  # > 0 — продаём излишек, < 0 — докупаем
+    if pair.startswith(f"{currency}-"):
+        side = "sell" if excess > 0 else "buy"
+        size = order_size(pair, "sell", excess) if excess > 0 else order_size(pair, "buy", -excess * ask, price=ask)
+    else:  # Валюта — котировочная: продать её значит купить anchor
+        side = "buy" if excess > 0 else "sell"
+        size = order_size(pair, "buy", excess, price=ask) if excess > 0 else order_size(pair, "sell", -excess / bid)
+    if size is None:
+        return
+
+    logging.error(f"⚖️ Ребалансировка {currency}: {balance:.8g} вне полосы {low:.8g}…{high:.8g}, {side} {size} {pair}")
+    order_id = await place_order(pair, side, size)
+    if order_id:
+        await wait_for_order(order_id)
+
+async def inventory_rebalancer():
+    """Фоновое выравнивание запаса после параллельных сделок (и начальная закупка до целей)."""
+    while True:
+        for currency in INVENTORY_TARGETS:
+            if currency == INVENTORY_ANCHOR:
+                continue  # Anchor принимает весь дрейф остальных валют
+            try:
+                async with inventory_lock:
+                    await rebalance_currency(currency)
+            except Exception as e:
+                logging.error(f"⚠️ Ошибка ребалансировки {currency}: {e}")
+        await asyncio.sleep(INVENTORY_REBALANCE_INTERVAL)
+
+async def execute_parallel(pair1, pair2, pair3, sizing, tick_ns):
+    """Три ноги одновременно: покупка base1 за quote1, продажа base1 и quote2 из запаса.
+    Продаём столько, сколько ожидаем получить от предыдущей ноги, так что запас в среднем не меняется."""
+    base1, quote1 = pair1.split("-")
+    quote2 = pair2.split("-")[1]
+    if inventory_band(base1) is None or inventory_band(quote2) is None:
+        logging.warning("⚠️ Нет цели запаса для %s или %s, треугольник %s → %s → %s пропущен",
+                        base1, quote2, pair1, pair2, pair3)
+        return False
+
+    keep = 1 - TRADE_FEE
+    expected2 = sizing.notional / sizing.vwap1 * keep
+    expected3 = expected2 * sizing.vwap2 * keep
+    scale = min(1.0, await get_balance(base1) / expected2, await get_balance(quote2) / expected3)
+    if scale < 1:  # Запаса не хватает на весь объём — уменьшаем первую ногу под него
+        sizing = size_triangle(pair1, pair2, pair3, max_notional=sizing.notional * scale)
+        if sizing is None or sizing.profit <= 0:
+            return False
+        expected2 = sizing.notional / sizing.vwap1 * keep
+        expected3 = expected2 * sizing.vwap2 * keep
+    if sizing.notional < ORDER_SIZE:
+        logging.warning("⚠️ Запас %s/%s позволяет только %s %s, меньше ORDER_SIZE", base1, quote2, sizing.notional, quote1)
+        return False
+
+    legs = [
+        (pair1, "buy", order_size(pair1, "buy", sizing.notional, price=sizing.vwap1)),
+        (pair2, "sell", order_size(pair2, "sell", expected2)),
+        (pair3, "sell", order_size(pair3, "sell", expected3)),
+    ]
+    if any(size is None for _, _, size in legs):
+        logging.warning("⚠️ Объём %s %s не проходит по tickSz/lotSz/minSz одной из ног %s, %s, %s",
+                        sizing.notional, quote1, pair1, pair2, pair3)
+        return False
+
+    async with inventory_lock:
+        record_latency("tick_to_order", tick_ns)
+        if BATCH_ORDERS:
+            order_ids = await place_orders(legs)
+        else:
+            order_ids = await asyncio.gather(*(place_order(*leg) for leg in legs))
+        placed = [k for k, order_id in enumerate(order_ids) if order_id]
+        fills = [None, None, None]
+        for k, fill in zip(placed, await asyncio.gather(*(wait_for_order(order_ids[k]) for k in placed))):
+            fills[k] = fill
+
+    if any(fill is None or fill.filled_size <= 0 for fill in fills):
+        logging.error(f"🚨 Параллельная сделка {pair1} → {pair2} → {pair3} исполнилась не полностью, "
+                      f"запас выровняет ребалансировка")
+        return False
+
+    record_latency("tick_to_trade", tick_ns)
+    spent = fills[0].filled_size * fills[0].avg_price
+    final_amount = fill_received(fills[2])
+    logging.info("💵 Итог (параллельно): потрачено %s %s, получено %s %s", spent, quote1, final_amount, quote1)
+    trade_log.info("trade", {
+        "mode": "parallel", "route": (pair1, pair2, pair3), "orders": tuple(order_ids),
+        "spent": spent, "spent_currency": quote1, "received": final_amount, "received_currency": quote1,
+        "prices": tuple(fill.avg_price for fill in fills),
+    })
+    return True
+
 
 # ✅ Основная логика треугольного арбитража
 async def triangular_arbitrage():
     """Основная логика треугольного арбитража"""
+    # Приватную сессию и ребалансировку запускает рантайм (`main`); сессия логинится заранее,
+    # чтобы первая сделка не ждала рукопожатия
     while True:
+        # Ждём лучшую свежую возможность; треугольник заблокирован, пока исполняется
+        key, row, tick_ns = await opportunities.next()
         try:
-            conn = sqlite3.connect("arbitrage.db")
-            cursor = conn.cursor()
-            cursor.execute("SELECT * FROM tab_3 ORDER BY final_balance DESC LIMIT 1")
-            row = cursor.fetchone()
-            conn.close()
-            
-            if not row:
-                logging.info("ℹ️ Нет доступных треугольников для арбитража")
-                await asyncio.sleep(2)
-                continue
-            
             pair1, bid1, ask1, pair2, bid2, ask2, pair3, bid3, ask3, final_balance = row
-            logging.info(f"🔍 Выбран треугольник: {pair1}, {pair2}, {pair3} с финальным балансом {final_balance}")
-
-            # 🔄 Получаем актуальные цены из `tab_2`
-            conn = sqlite3.connect("arbitrage.db")
-            cursor = conn.cursor()
-            cursor.execute("SELECT ask1 FROM tab_2 WHERE pair1 = ?", (pair1,))
-            ask1 = float(cursor.fetchone()[0])
-
-            cursor.execute("SELECT bid2 FROM tab_2 WHERE pair2 = ?", (pair2,))
-            bid2 = float(cursor.fetchone()[0])
-
-            cursor.execute("SELECT bid3 FROM tab_2 WHERE pair3 = ?", (pair3,))
-            bid3 = float(cursor.fetchone()[0])
-            conn.close()
+            logging.info("🔍 Выбран треугольник: %s, %s, %s с финальным балансом %s", pair1, pair2, pair3, final_balance)
 
             # 🔄 Получаем актуальные балансы из БД
             base1, quote1 = pair1.split("-")
             base2, quote2 = pair2.split("-")
             base3, quote3 = pair3.split("-")
 
+            if not triangle_chains(pair1, pair2, pair3):
+                logging.warning("⚠️ Маршрут %s → %s → %s не замыкается покупкой и двумя продажами", pair1, pair2, pair3)
+                continue
+
             # ✅ **Первая сделка: BUY `pair1`**
             balance_quote1 = await get_balance(quote1)
-            logging.info(f"💰 Баланс {quote1}: {balance_quote1}, требуется: {ORDER_SIZE}")
+            logging.info("💰 Баланс %s: %s, требуется: %s", quote1, balance_quote1, ORDER_SIZE)
+
+            # 📐 Объём по глубине стаканов всех трёх ног, не больше доступного баланса
+            sizing = size_triangle(pair1, pair2, pair3, max_notional=balance_quote1)
+            if sizing is None or sizing.profit <= 0:
+                logging.warning("⚠️ Стаканы %s, %s, %s не дают прибыльного объёма", pair1, pair2, pair3)
+                continue
 
-            if quote1 in TARGET_CURRENCIES and balance_quote1 > ORDER_SIZE:
-                amount1 = ORDER_SIZE 
-                logging.info(f"📊 Рассчитанный объём первой сделки: {amount1} {base1} по цене {ask1}")
+            if EXECUTION_MODE == "parallel":
+                if quote1 in TARGET_CURRENCIES:
+                    await execute_parallel(pair1, pair2, pair3, sizing, tick_ns)
+                continue
 
-                if amount1 < MIN_TRADE_SIZE:
-                    logging.warning(f"⚠️ Слишком малый ордер: {amount1} < {MIN_TRADE_SIZE}")
+            if quote1 in TARGET_CURRENCIES and sizing.notional >= ORDER_SIZE:
+                amount1 = order_size(pair1, "buy", sizing.notional, price=sizing.vwap1)
+                logging.info("📊 Рассчитанный объём первой сделки: %s %s, VWAP %s, ожидаемая прибыль %.6f %s",
+                             amount1, quote1, sizing.vwap1, sizing.profit, quote1)
+
+                # Проверяем все три ноги до отправки: отказ биржи стоит целого круга запрос-ответ
+                expected2 = sizing.notional / sizing.vwap1 * (1 - TRADE_FEE)
+                expected3 = expected2 * sizing.vwap2 * (1 - TRADE_FEE)
+                if amount1 is None or order_size(pair2, "sell", expected2) is None \
+                        or order_size(pair3, "sell", expected3) is None:
+                    logging.warning("⚠️ Объём %s %s не проходит по tickSz/lotSz/minSz одной из ног %s, %s, %s",
+                                    sizing.notional, quote1, pair1, pair2, pair3)
                     continue
 
+                record_latency("tick_to_order", tick_ns)
                 order_id = await place_order(pair1, "buy", amount1)
     
                 if order_id:
-                    logging.info(f"✅ Ордер на покупку {pair1} создан: {order_id}")
+                    logging.info("✅ Ордер на покупку %s создан: %s", pair1, order_id)
                 else:
                     logging.error(f"🚨 Ошибка! Биржа отклонила ордер на {pair1}.")
                     continue
 
-                if not await wait_for_order(order_id):
+                fill1 = await wait_for_order(order_id)
+                if fill1 is None or fill1.filled_size <= 0:
                     logging.error(f"🚨 Ордер {order_id} на {pair1} не исполнился!")
                     continue
             else:
-                logging.error(f"⚠️ Недостаточно {quote1} для первой сделки")
+                logging.error(f"⚠️ Недостаточно {quote1} или объёма стакана для первой сделки")
                 continue
 
-            # ✅ **Вторая сделка: SELL `pair2`**
-            balance_base1 = balance_quote1 / bid2 * (1 - 0.0011)
-            if balance_base1 < MIN_TRADE_SIZE:
-                logging.warning(f"⚠️ Недостаточный баланс {base1} для продажи: {balance_base1}")
+            # ✅ **Вторая сделка: SELL `pair2`** — продаём ровно то, что реально купили
+            balance_base1 = fill_received(fill1)
+            size2 = order_size(pair2, "sell", balance_base1)
+            if size2 is None:
+                logging.warning("⚠️ Недостаточный баланс %s для продажи: %s", base1, balance_base1)
                 continue
 
-            order_id = await place_order(pair2, "sell", balance_base1)
-            if not await wait_for_order(order_id):
+            order_id = await place_order(pair2, "sell", size2)
+            fill2 = await wait_for_order(order_id) if order_id else None
+            if fill2 is None or fill2.filled_size <= 0:
+                logging.error(f"🚨 Вторая сделка на {pair2} не исполнилась!")
                 continue
 
             # ✅ **Третья сделка: SELL `pair3`**
-            balance_base3 = balance_base1 * bid2 * (1 - 0.0011)
-            if balance_base3 < MIN_TRADE_SIZE:
-                logging.warning(f"⚠️ Недостаточный баланс {base2} для продажи: {balance_base3}")
+            balance_base3 = fill_received(fill2)
+            size3 = order_size(pair3, "sell", balance_base3)
+            if size3 is None:
+                logging.warning("⚠️ Недостаточный баланс %s для продажи: %s", base3, balance_base3)
                 continue
 
-            order_id = await place_order(pair3, "sell", balance_base3)
-            if not await wait_for_order(order_id):
+            order_id = await place_order(pair3, "sell", size3)
+            fill3 = await wait_for_order(order_id) if order_id else None
+            if fill3 is None or fill3.filled_size <= 0:
+                logging.error(f"🚨 Третья сделка на {pair3} не исполнилась!")
                 continue
 
+            record_latency("tick_to_trade", tick_ns)
+            final_amount = fill_received(fill3)
+            logging.info("💵 Итог: потрачено %s %s, получено %s %s (цены исполнения %s, %s, %s)",
+                         amount1, quote1, final_amount, quote3, fill1.avg_price, fill2.avg_price, fill3.avg_price)
+            trade_log.info("trade", {
+                "mode": "sequential", "route": (pair1, pair2, pair3), "orders": (fill1.order_id, fill2.order_id, fill3.order_id),
+                "spent": amount1, "spent_currency": quote1, "received": final_amount, "received_currency": quote3,
+                "prices": (fill1.avg_price, fill2.avg_price, fill3.avg_price),
+            })
             logging.info("🏆 ✅ Треугольный арбитраж завершен!")
             print("🏆 ✅ Треугольный арбитраж завершен!")
 
         except Exception as e:
             logging.error(f"🚨 Ошибка в арбитраже: {e}")
             await asyncio.sleep(2)  # ✅ Если ошибка — подождать 
+        finally:
+            opportunities.release(key)
+
+
+# Локальная биржа для сквозных тестов задержки: публичный и приватный WebSocket OKX v5 и REST инструментов
+class MockExchange:
+    """Синтетические (или воспроизведённые из журнала) стаканы и симуляция рыночных ордеров."""
+
+    def __init__(self, rate=1000, feed_path=None, speed=1.0, fill_delay_ms=5, alts=20, seed=1, inventory=0.0):
+        self.rate = rate  # Обновлений стаканов в секунду (синтетический режим)
+        self.feed_path = feed_path
+        self.speed = speed
+        self.fill_delay = fill_delay_ms / 1000
+        self.rng = random.Random(seed)
+        self.books = {}  # instId -> OrderBook (зеркало того, что видят подписчики)
+        self.levels = {}  # instId -> {"bids": {цена: объём}, "asks": {...}} в строках (синтетический режим)
+        self.mid = {}
+        self.tick = {}
+        self.subscribers = {}  # instId -> {публичное соединение: канал}
+        self.private = set()  # Приватные соединения, подписанные на account/orders
+        self.balances = {"USDT": 10_000.0, "USDC": 10_000.0}
+        self.reserved = {}  # валюта -> заморожено под принятые, но ещё не исполненные ордера
+        self.last_tick_sent = {}  # instId -> perf_counter последнего отправленного обновления
+        self.tick_to_order = []  # Задержки «тик → ордер» в мс
+        self.sent = 0
+        self.orders = 0
+        self.inventory = inventory  # Стартовый запас каждой валюты в пересчёте на USDT (синтетический режим)
+        self.instruments = self._feed_instruments() if feed_path else self._synthetic_instruments(alts)
+
+    def _synthetic_instruments(self, alts):
+        prices = {"USDT": 1.0, "USDC": 1.0, "BTC": 60_000.0, "ETH": 3_000.0}
+        prices.update({f"ALT{i}": self.rng.uniform(0.01, 100) for i in range(alts)})
+        if self.inventory:
+            for currency, price in prices.items():
+                self.balances.setdefault(currency, self.inventory / price)
+        pairs = [("BTC", "USDT"), ("ETH", "USDT"), ("ETH", "BTC"), ("USDC", "USDT"), ("BTC", "USDC"), ("ETH", "USDC")]
+        for i in range(alts):
+            pairs += [(f"ALT{i}", quote) for quote in ("USDT", "USDC", "BTC", "ETH") if self.rng.random() < 0.8]
+        instruments = []
+        for base, quote in pairs:
+            pair = f"{base}-{quote}"
+            mid = prices[base] / prices[quote]
+            self.mid[pair] = mid
+            self.tick[pair] = 10 ** (math.floor(math.log10(mid)) - 4)
+            instruments.append({
+                "instId": pair, "instType": "SPOT", "baseCcy": base, "quoteCcy": quote, "state": "live",
+                "tickSz": self._fmt(self.tick[pair], self.tick[pair]), "lotSz": "0.0001", "minSz": "0.0001",
+            })
+            self._regenerate(pair)
+        return instruments
+
+    def _feed_instruments(self):
+        pairs = {}
+        for _, source, message in iter_feed(self.feed_path):
+            if source == SOURCE_PUBLIC:
+                data = json.loads(message)
+                if "arg" in data and "instId" in data["arg"]:
+                    pairs[data["arg"]["instId"]] = None
+        return [
+            {"instId": pair, "instType": "SPOT", "baseCcy": pair.split("-")[0], "quoteCcy": pair.split("-")[1],
+             "state": "live", "tickSz": "0.00000001", "lotSz": "0.00000001", "minSz": "0.00000001"}
+            for pair in pairs
+        ]
+
+    @staticmethod
+    def _fmt(value, tick):
+        decimals = max(0, -math.floor(math.log10(tick) + 1e-9))
+        return f"{value:.{decimals}f}"
+
+    def _regenerate(self, pair, depth=20):
+        """Случайное блуждание середины и новые уровни вокруг неё; возвращает разницу со старыми уровнями."""
+        self.mid[pair] *= math.exp(self.rng.gauss(0, 0.0005))
+        mid, tick = self.mid[pair], self.tick[pair]
+        best_bid = math.floor(mid / tick) * tick
+        old = self.levels.get(pair, {"bids": {}, "asks": {}})
+        prices = {
+            "bids": [self._fmt(best_bid - k * tick, tick) for k in range(depth)],
+            "asks": [self._fmt(best_bid + (k + 1) * tick, tick) for k in range(depth)],
+        }
+        # Объём меняется только у двух лучших уровней, остальные уровни сохраняют прежний объём
+        new = {
+            side: {
+                px: old[side][px] if k >= 2 and px in old[side] else f"{self.rng.uniform(0.1, 50):.4f}"
+                for k, px in enumerate(prices[side])
+            }
+            for side in ("bids", "asks")
+        }
+        self.levels[pair] = new
+        return {
+            side: [[px, sz, "0", "1"] for px, sz in new[side].items() if old[side].get(px) != sz]
+            + [[px, "0", "0", "0"] for px in old[side] if px not in new[side]]
+            for side in ("bids", "asks")
+        }
+
+    def _snapshot(self, pair):
+        book = self.books.get(pair)
+        if book is None:
+            book = self.books[pair] = OrderBook(pair)
+            bids = sorted(self.levels[pair]["bids"].items(), key=lambda level: -float(level[0]))
+            asks = sorted(self.levels[pair]["asks"].items(), key=lambda level: float(level[0]))
+            book.apply("snapshot", {"bids": [[px, sz, "0", "1"] for px, sz in bids],
+                                    "asks": [[px, sz, "0", "1"] for px, sz in asks], "seqId": 1})
+        data = {
+            "asks": [[px, sz, "0", "1"] for px, sz in book.raw_asks()],
+            "bids": [[px, sz, "0", "1"] for px, sz in book.raw_bids()],
+            "ts": str(int(time.time() * 1000)), "checksum": book.checksum(),
+            "prevSeqId": -1, "seqId": book.seq_id,
+        }
+        return {"arg": {"channel": "books", "instId": pair}, "action": "snapshot", "data": [data]}
+
+    def _top_levels(self, pair, channel):
+        """Сообщение `books5` / `bbo-tbt` по зеркальному стакану."""
+        book = self.books[pair]
+        depth = 1 if channel == "bbo-tbt" else 5
+        data = {
+            "asks": [[px, sz, "0", "1"] for px, sz in book.raw_asks(depth)],
+            "bids": [[px, sz, "0", "1"] for px, sz in book.raw_bids(depth)],
+            "ts": str(int(time.time() * 1000)), "seqId": book.seq_id,
+        }
+        return {"arg": {"channel": channel, "instId": pair}, "data": [data]}
+
+    async def _broadcast(self, pair, message):
+        payloads = {"books": message if isinstance(message, (str, bytes)) else json.dumps(message)}
+        subscribers = self.subscribers.get(pair, {})
+        for ws, channel in list(subscribers.items()):
+            if channel not in payloads:
+                payloads[channel] = json.dumps(self._top_levels(pair, channel))
+            try:
+                await ws.send(payloads[channel])
+                self.sent += 1
+            except Exception:
+                subscribers.pop(ws, None)
+        self.last_tick_sent[pair] = time.perf_counter()
+
+    async def synthetic_feed(self):
+        batch_interval = 0.01
+        while True:
+            await asyncio.sleep(batch_interval)
+            active = [pair for pair, subs in self.subscribers.items() if subs and pair in self.books]
+            if not active:
+                continue
+            for _ in range(max(1, int(self.rate * batch_interval))):
+                pair = self.rng.choice(active)
+                book = self.books[pair]
+                delta = self._regenerate(pair)
+                data = {**delta, "ts": str(int(time.time() * 1000)), "prevSeqId": book.seq_id, "seqId": book.seq_id + 1}
+                book.apply("update", data)
+                data["checksum"] = book.checksum()
+                await self._broadcast(pair, {"arg": {"channel": "books", "instId": pair}, "action": "update", "data": [data]})
+
+    async def replay_feed(self):
+        started = time.perf_counter()
+        first_ts = None
+        for received_at, source, message in iter_feed(self.feed_path):
+            if source != SOURCE_PUBLIC:
+                continue
+            first_ts = first_ts or received_at
+            if self.speed > 0:
+                delay = (received_at - first_ts) / 1e9 / self.speed - (time.perf_counter() - started)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            data = json.loads(message)
+            if "arg" not in data or "data" not in data:
+                continue
+            pair = data["arg"]["instId"]
+            self.books.setdefault(pair, OrderBook(pair)).apply(data.get("action", "snapshot"), data["data"][0])
+            await self._broadcast(pair, message.decode())
+
+    async def handle_ws(self, ws, path=None):
+        path = path or getattr(ws, "path", None) or ws.request.path
+        private = path.rstrip("/").endswith("private")
+        try:
+            async for message in ws:
+                if message == "ping":
+                    await ws.send("pong")
+                    continue
+                request = json.loads(message)
+                op = request.get("op")
+                if op == "login":
+                    await ws.send(json.dumps({"event": "login", "code": "0", "msg": "", "connId": "mock"}))
+                elif op == "subscribe":
+                    for arg in request.get("args", []):
+                        await ws.send(json.dumps({"event": "subscribe", "arg": arg, "connId": "mock"}))
+                        if private:
+                            self.private.add(ws)
+                            if arg.get("channel") == "account":
+                                await self._push_account(list(self.balances))
+                        elif arg.get("instId") in {item["instId"] for item in self.instruments}:
+                            pair, channel = arg["instId"], arg.get("channel", "books")
+                            self.subscribers.setdefault(pair, {})[ws] = channel
+                            if pair in self.books or not self.feed_path:
+                                snapshot = self._snapshot(pair)
+                                await ws.send(json.dumps(snapshot if channel == "books" else self._top_levels(pair, channel)))
+                elif op == "unsubscribe":
+                    for arg in request.get("args", []):
+                        self.subscribers.get(arg.get("instId"), {}).pop(ws, None)
+                        await ws.send(json.dumps({"event": "unsubscribe", "arg": arg, "connId": "mock"}))
+                elif op in ("order", "batch-orders") and private:
+                    data = [self._place(args) for args in request.get("args", [])]
+                    # Как у OKX: "1" — отклонены все ордера, "2" — часть пакета
+                    accepted = sum(item["sCode"] == "0" for item in data)
+                    code = "0" if accepted == len(data) else "1" if accepted == 0 else "2"
+                    await ws.send(json.dumps({"id": request.get("id", ""), "op": op, "code": code, "msg": "", "data": data}))
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            self.private.discard(ws)
+            for subs in self.subscribers.values():
+                subs.pop(ws, None)
+
+    def _place(self, args):
+        """Принимает ордер, замораживает средства, планирует исполнение и возвращает элемент `data` ответа.
+        Без достаточного баланса — отказ с кодом OKX 51008, как у настоящей биржи."""
+        self.orders += 1
+        pair, side, amount = args["instId"], args["side"], float(args["sz"])
+        if pair in self.last_tick_sent:
+            self.tick_to_order.append((time.perf_counter() - self.last_tick_sent[pair]) * 1000)
+        base, quote = pair.split("-")
+        currency = quote if side == "buy" else base  # buy тратит валюту котировки, sell — базовую
+        if self.balances.get(currency, 0.0) - self.reserved.get(currency, 0.0) < amount:
+            return {"ordId": "", "clOrdId": "", "tag": "", "sCode": "51008",
+                    "sMsg": f"Order failed. Insufficient {currency} balance in account."}
+        self.reserved[currency] = self.reserved.get(currency, 0.0) + amount
+        order_id = str(10_000_000 + self.orders)
+        asyncio.get_running_loop().call_later(
+            self.fill_delay, lambda: asyncio.ensure_future(self._fill(order_id, pair, side, amount))
+        )
+        return {"ordId": order_id, "clOrdId": "", "tag": "", "sCode": "0", "sMsg": ""}
+
+    async def _fill(self, order_id, pair, side, amount):
+        # Рыночный ордер идёт по зеркальному стакану: buy — сумма в валюте котировки, sell — в базовой
+        base, quote = pair.split("-")
+        currency = quote if side == "buy" else base
+        self.reserved[currency] -= amount  # Списываем ниже ровно исполненное, не больше замороженного
+        book = self.books.get(pair)
+        spent = filled = notional = 0.0
+        for price, size in ((book.asks() if side == "buy" else book.bids()) if book else []):
+            take = min(price * size if side == "buy" else size, amount - spent)
+            spent += take
+            filled += take / price if side == "buy" else take
+            notional += take if side == "buy" else take * price
+            if spent >= amount:
+                break
+        if side == "buy":
+            fee, fee_ccy = -filled * TRADE_FEE, base
+            self.balances[quote] = self.balances.get(quote, 0.0) - notional
+            self.balances[base] = self.balances.get(base, 0.0) + filled + fee
+        else:
+            fee, fee_ccy = -notional * TRADE_FEE, quote
+            self.balances[base] = self.balances.get(base, 0.0) - filled
+            self.balances[quote] = self.balances.get(quote, 0.0) + notional + fee
+        now = str(int(time.time() * 1000))
+        order = {
+            "instId": pair, "ordId": order_id, "clOrdId": "", "px": "", "sz": str(amount), "side": side,
+            "ordType": "market", "accFillSz": str(filled), "avgPx": str(notional / filled if filled else ""),
+            "fee": str(fee), "feeCcy": fee_ccy, "cTime": now, "uTime": now,
+        }
+        if spent >= amount * (1 - 1e-9):
+            states = ["filled"]
+        elif filled > 0:
+            states = ["partially_filled", "canceled"]  # Стакан кончился: остаток рыночного ордера снимается
+        else:
+            states = ["canceled"]
+        for state in states:
+            message = json.dumps({"arg": {"channel": "orders", "instType": "SPOT", "uid": "mock"},
+                                  "data": [{**order, "state": state}]})
+            for ws in list(self.private):
+                await ws.send(message)
+        await self._push_account([base, quote])
+
+    async def _push_account(self, currencies):
+        details = [{"ccy": ccy, "availBal": str(self.balances.get(ccy, 0.0)), "frozenBal": "0"} for ccy in currencies]
+        message = json.dumps({"arg": {"channel": "account", "uid": "mock"}, "data": [{"details": details}]})
+        for ws in list(self.private):
+            await ws.send(message)
+
+    async def handle_http(self, reader, writer):
+        # Минимальный HTTP/1.1: GET /api/v5/public/instruments
+        request_line = (await reader.readline()).decode()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        path = request_line.split(" ")[1] if " " in request_line else ""
+        if path.startswith("/api/v5/public/instruments"):
+            status, body = "200 OK", json.dumps({"code": "0", "msg": "", "data": self.instruments})
+        else:
+            status, body = "404 Not Found", json.dumps({"code": "404", "msg": "not found", "data": []})
+        payload = body.encode()
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\n"
+                     f"Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode() + payload)
+        await writer.drain()
+        writer.close()
+
+    async def report(self, interval=10):
+        previous = 0
+        while True:
+            await asyncio.sleep(interval)
+            latencies = sorted(self.tick_to_order)
+            print(f"📡 Отправлено {(self.sent - previous) / interval:.0f} сообщ./сек, ордеров {self.orders}, "
+                  f"тик→ордер p50/p99 {percentile(latencies, 0.5):.2f}/{percentile(latencies, 0.99):.2f} мс")
+            previous = self.sent
+
+    async def serve(self, host="127.0.0.1", port=8765):
+        ws_server = await websockets.serve(self.handle_ws, host, port)
+        http_server = await asyncio.start_server(self.handle_http, host, port + 1)
+        print("🧪 Локальная биржа запущена. Для бота:")
+        print(f"   OKX_WS_URL=ws://{host}:{port}/ws/v5/public OKX_PRIVAT_URL=ws://{host}:{port}/ws/v5/private "
+              f"OKX_API_URL=http://{host}:{port + 1}/api/v5")
+        async with ws_server, http_server:
+            await asyncio.gather(self.replay_feed() if self.feed_path else self.synthetic_feed(), self.report())
+
+
+# Самопроверка без биржи: python project_6.5_GIT.py self-check (код возврата 1 при сбое)
+def self_check_runtime_add():
+    """Инструменты, добавленные на ходу, попадают в хранилище, треугольники и пакетный движок"""
+    build_currency_graph(["BTC-USDT", "ETH-USDT", "ETH-BTC"])
+    set_triangles(triangle for triangle in (cycle_pairs(cycle) for cycle in find_cycles(3))
+                  if triangle_passes_filter(*triangle))
+    engine = triangle_engine
+
+    async def add_pairs():
+        manager = SubscriptionManager(url="ws://127.0.0.1:9")  # Подключаться некуда: проверяем только учёт
+        task = asyncio.create_task(manager.run(list(quote_store.pairs)))
+        await asyncio.sleep(0.01)
+        manager.add(["SOL-USDT", "SOL-BTC"])
+        await asyncio.sleep(0.01)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return {pair for connection in manager.connections for pair in connection.pairs}
+
+    subscribed = asyncio.run(add_pairs())
+    assert {"SOL-USDT", "SOL-BTC"} <= quote_store.index.keys(), "новые инструменты не в хранилище котировок"
+    assert {"SOL-USDT", "SOL-BTC"} <= subscribed, "на новые инструменты нет подписки"
+    route = ("SOL-USDT", "SOL-BTC", "BTC-USDT")
+    assert route in triangles and pair_triangles.get("SOL-BTC"), "треугольник с новыми инструментами не добавлен"
+    assert engine is None or triangle_engine is not engine, "пакетный движок не пересобран"
+
+    # Покупка SOL за USDT, продажа за BTC на 3 % дороже справедливой цены, BTC обратно в USDT
+    for pair, price in {"BTC-USDT": 60_000, "ETH-USDT": 3_000, "ETH-BTC": 0.05, "SOL-USDT": 100,
+                        "SOL-BTC": 100 / 60_000 * 1.03}.items():
+        quote_store.update(pair, price * 0.9999, price * 1.0001, 1e6, 1e6)
+    rows = triangle_engine.evaluate() if triangle_engine is not None else [
+        row for row in (evaluate_triangle(*triangle) for triangle in triangles) if row and row[-1] > PROFIT_PERCENT
+    ]
+    assert route in {row[0:9:3] for row in rows}, "прибыльный треугольник с новыми инструментами не найден"
+
+def self_check_bad_snapshot():
+    """Первый снимок с неверной checksum ведёт к переподписке, хвост обновлений до нового снимка — нет"""
+    order_books.pop("BTC-USDT", None)
+    levels = {"bids": [["60000", "1", "0", "1"]], "asks": [["60001", "1", "0", "1"]], "seqId": 1}
+    message = {"arg": {"channel": "books", "instId": "BTC-USDT"}, "action": "snapshot",
+               "data": [dict(levels, checksum=OrderBook("BTC-USDT").checksum() + 1)]}
+    assert apply_book_message(message) is False, "битый первый снимок не ведёт к переподписке"
+    update = {"arg": message["arg"], "action": "update", "data": [{"bids": [], "asks": [], "prevSeqId": 1, "seqId": 2}]}
+    assert apply_book_message(update) is None, "хвост обновлений до снимка снова переподписывает"
+
+def self_check_precision():
+    """Округление до lotSz/tickSz не ошибается на представлении float"""
+    fine, whole = Precision("0.1", "0.00000001", "0.00001"), Precision("0.01", "1", "1")
+    for got, expected in ((fine.round_size(0.29), "0.29000000"), (whole.round_size(2.9999999999), "2"),
+                          (whole.round_size(3.0), "3"), (fine.round_price(0.3, up=True), "0.3"),
+                          (whole.round_price(1.0000000001, up=True), "1.01"), (fine.round_price(0.7), "0.7")):
+        assert got == expected, f"{got} вместо {expected}"
+
+SELF_CHECKS = [self_check_runtime_add, self_check_bad_snapshot, self_check_precision]
+
+def self_check():
+    failed = 0
+    for check in SELF_CHECKS:
+        try:
+            check()
+            print(f"✅ {check.__doc__}")
+        except AssertionError as e:
+            failed += 1
+            print(f"❌ {check.__doc__}: {e}")
+    return failed
 
 
 if __name__ == "__main__":
-    pairs = fetch_trading_pairs()
-    find_triangular_arbitrage()
-    filter_triangles()
-    get_unique_pairs()
-    threading.Thread(target=lambda: asyncio.run(main()), daemon=True).start()
-    threading.Thread(target=lambda: asyncio.run(subscribe_private_ws()), daemon=True).start()
-    threading.Thread(target=analyze_triangles_thread, daemon=True).start()
-    threading.Thread(target=run_ws, daemon=True).start()
+    if sys.argv[1:2] == ["self-check"]:
+        sys.exit(1 if self_check() else 0)
+    if sys.argv[1:2] == ["bench-engine"]:
+        benchmark_triangle_engine()
+        sys.exit(0)
+    if sys.argv[1:2] == ["bench-decode"]:
+        benchmark_decoders()
+        sys.exit(0)
+    if sys.argv[1:2] == ["replay"]:
+        # python project_6.5_GIT.py replay feed.rec [скорость, 0 — максимально быстро]
+        init_database()
+        load_triangles()
+        run_loop(replay_feed(sys.argv[2], float(sys.argv[3]) if len(sys.argv) > 3 else 1.0))
+        sys.exit(0)
+
+    if sys.argv[1:2] == ["backtest"]:
+        # python project_6.5_GIT.py backtest feed.rec profit=1005,1010 latency=20,50,20/50/30 targets=USDT+USDC
+        init_database()
+        sweep_backtest(sys.argv[2], {
+            key: value.split(",") for key, value in (arg.split("=", 1) for arg in sys.argv[3:])
+        })
+        sys.exit(0)
+
+    if sys.argv[1:2] == ["mock-exchange"]:
+        # python project_6.5_GIT.py mock-exchange port=8765 rate=1000 fill_delay_ms=5 feed=feed.rec speed=1 inventory=0
+        options = dict(arg.split("=", 1) for arg in sys.argv[2:])
+        exchange = MockExchange(
+            rate=float(options.get("rate", 1000)), feed_path=options.get("feed"),
+            speed=float(options.get("speed", 1)), fill_delay_ms=float(options.get("fill_delay_ms", 5)),
+            inventory=float(options.get("inventory", 0)),
+        )
+        try:
+            run_loop(exchange.serve(port=int(options.get("port", 8765))))
+        except KeyboardInterrupt:
+            print("\n🛑 Локальная биржа остановлена.")
+        sys.exit(0)
+
+    init()
+    if RECORD_PATH:
+        feed_recorder = MarketRecorder(RECORD_PATH)
+    if INGEST_WORKERS > 0:
+        quote_store = SharedQuoteStore()
+        atexit.register(quote_store.close)
+    prepare_triangles()
+    if INGEST_WORKERS > 0:
+        start_ingest_workers()
+        watcher_thread = threading.Thread(target=shared_quote_watcher, name="shared-quote-watcher", daemon=True)
+        watcher_thread.start()
+    persistence.start()
     try:
         print("💡 Инициализация треугольного арбитража... 🟡")
-        asyncio.run(triangular_arbitrage())
+        run_loop(main())
+        print("\n🛑 Скрипт арбитража остановлен.")
     except KeyboardInterrupt:
         print("\n🛑 Скрипт арбитража остановлен пользователем.")
     finally:
         print("✨ Завершение программы. До новых сделок! 🚀")
-    while True:
-        time.sleep(10)